@@ -22,38 +22,467 @@
 
 # flake8: noqa
 
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+import concurrent.futures
+import contextlib
 import errno
 import hashlib
+import mmap
 import os
 from pathlib import Path
 import plistlib
+import sys
+import time
 import uuid as UUID
 import xml.parsers.expat
 
 # Disable encryption for now
 # import vpenc
 
+from manifest import Manifest, stat_signature
 import tokenizer
+from wordmatcher import WordMatcher
 from wordtrie import WordTrie
 
 
+# Items with these UTIs have no page body stored alongside their plist.
+ALIAS_UTIS = ['com.fm.page-alias', 'com.fm.file-alias']
+
+# The name of the title trie snapshot in the document directory.
+TRIE_SNAPSHOT_NAME = 'trie.bin'
+
+# Default upper bound (in bytes of UTF-8 page text) on the lazily loaded
+# page bodies kept in memory.
+DEFAULT_ITEM_CACHE_SIZE = 64 * 1024 * 1024
+
+# Default number of page bodies DataStore.iter_items() reads ahead of the
+# page currently being processed.
+DEFAULT_READ_AHEAD = 32
+
+# Size of the reads used to hash page bodies while validating a document.
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Default number of bytes of page text an ItemBatch buffers before writing
+# the pending pages to disk.
+DEFAULT_BATCH_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+# The plist fields kept in memory for every item. Everything else in an item
+# plist is only read when it is asked for. See ItemRecord.
+ITEM_FIELDS = ('uuid', 'key', 'displayName', 'uti', 'dataHash')
+
+
+# Returns the form of a page name used for case-insensitive name lookups. It
+# is also the item key and folds case the way the tokenizer folds words
+# (str.lower()), so a name that is found here links the same way.
+def normalize_name(name):
+    return name.lower()
+
+
+# The version of the way title_words() splits page names into words,
+# including the tokenizer it uses. It is stored in trie snapshots, so bump it
+# whenever a change would make a saved trie disagree with a new one.
+TITLE_WORDS_VERSION = 1
+
+
+# Returns the words of a page name as they are stored in the trie.
+def title_words(name):
+    return tokenizer.tokenize_text(normalize_name(name))
+
+
+# s may be a str or a bytes-like object (such as the view returned by
+# DataStore.item_view()), which is hashed without copying it.
 def sha1_hash(s):
     sha1 = hashlib.sha1()
-    sha1.update(s.encode('utf-8'))
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    sha1.update(s)
+    return sha1.hexdigest()
+
+
+# Parses the item plists (and, if requested, the page bodies) stored in a
+# single pages/<hex> shard directory, or only the named plists in it if names
+# is given. This runs in a worker process when a document is opened in
+# parallel, so it only uses plain paths and returns picklable results. Plists
+# that fail to parse are reported back by UUID so the caller can skip them the
+# same way the serial path does.
+def load_shard(shard_path, load_bodies, names=None):
+    plists = []
+    bodies = {}
+    skipped = []
+
+    if names is None:
+        names = os.listdir(shard_path)
+
+    for entry in sorted(names):
+        if not entry.endswith('.plist'):
+            continue
+
+        item_uuid = entry[:-len('.plist')]
+        try:
+            with open(os.path.join(shard_path, entry), 'rb') as fp:
+                item_plist = plistlib.load(fp, fmt=plistlib.FMT_XML)
+        except xml.parsers.expat.ExpatError:
+            skipped.append(item_uuid)
+            continue
+
+        plists.append((item_uuid, item_fields(item_plist)))
+
+        if load_bodies and item_plist['uti'] not in ALIAS_UTIS:
+            item_path = os.path.join(shard_path, item_uuid)
+            if not os.path.exists(item_path):
+                # FIXME: Raise an error that indicates the vpdoc is invalid or corrupt.
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), item_path)
+            with open(item_path, 'rb') as fp:
+                bodies[item_uuid] = fp.read().decode('utf-8')
+
+    return plists, bodies, skipped
+
+
+# Returns the SHA-1 of the file at path, reading it in large chunks. hashlib
+# releases the GIL while hashing large buffers, so several files can be hashed
+# at once on a thread pool.
+def sha1_file(path, buffer_size=HASH_BUFFER_SIZE):
+    sha1 = hashlib.sha1()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(str(path), 'rb', buffering=0) as fp:
+        while True:
+            count = fp.readinto(buffer)
+            if not count:
+                break
+            sha1.update(view[:count])
     return sha1.hexdigest()
 
 
+# The result of DataStore.check(). Each issue is a dict with the kind of
+# problem, the UUID of the item concerned (or None for document-wide
+# problems) and a human-readable message.
+class ValidationReport:
+    def __init__(self):
+        self.issues = []
+        self.hashed = 0
+        self.skipped = 0
+
+    @property
+    def valid(self):
+        return len(self.issues) == 0
+
+    def add(self, kind, uuid, message):
+        self.issues.append({'kind': kind, 'uuid': uuid, 'message': message})
+
+    def to_dict(self):
+        return {
+            'valid': self.valid,
+            'hashed': self.hashed,
+            'skipped': self.skipped,
+            'issues': self.issues,
+        }
+
+
+# Flush a file's contents to stable storage. fdatasync() skips metadata such as
+# timestamps that are not needed to read the file back, where it is available.
+def fsync_path(path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Flush a directory entry (e.g., a rename) to stable storage. Not every
+# platform can open a directory for this purpose; there it is skipped.
+def fsync_dir(path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Make a group of written temporary files durable and move them into place.
+# pending is a list of (temporary path, final path) tuples; a temporary path
+# of None means the final path is to be removed instead. Every temporary file
+# is flushed before any of them is renamed. Removals come first, plists
+# before page bodies, and renames after, plists last, so a plist never points
+# at a page body that is not there. Each directory is flushed once at the end.
+def commit_writes(pending):
+    if not pending:
+        return
+
+    for tmp_path, _ in pending:
+        if tmp_path is not None:
+            fsync_path(tmp_path)
+
+    removals = sorted((p for p in pending if p[0] is None), key=lambda p: not str(p[1]).endswith('.plist'))
+    renames = sorted((p for p in pending if p[0] is not None), key=lambda p: str(p[1]).endswith('.plist'))
+
+    directories = set()
+    for _, path in removals:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        directories.add(os.path.dirname(str(path)))
+
+    for tmp_path, path in renames:
+        os.replace(tmp_path, path)
+        directories.add(os.path.dirname(str(path)))
+
+    for directory in sorted(directories):
+        fsync_dir(directory)
+
+
+# Returns the values of ITEM_FIELDS in the plist, using None for missing fields.
+def item_fields(plist):
+    return tuple(plist.get(field) for field in ITEM_FIELDS)
+
+
+# A compact, read-mostly view of an item plist. Only the fields in
+# ITEM_FIELDS are kept in memory; the rest of the plist (attributes,
+# metaValues, dates and so on) is read from disk the first time one of them
+# is requested. ItemRecord behaves like the plist dict it replaces, so
+# record['displayName'] and record.get('aliases') both work.
+class ItemRecord(Mapping):
+    __slots__ = ('store', 'file_uuid', 'uuid', 'key', 'displayName', 'uti', 'dataHash', 'extras')
+
+    def __init__(self, store, file_uuid, uuid, key, displayName, uti, dataHash, extras=None):
+        # Share the string when the file name and the plist agree (which is
+        # always, for a valid document).
+        if file_uuid == uuid:
+            file_uuid = uuid
+
+        self.store = store
+        self.file_uuid = file_uuid
+        self.uuid = uuid
+        self.key = key
+        self.displayName = displayName
+        self.uti = sys.intern(uti) if uti is not None else None
+        self.dataHash = dataHash
+        self.extras = extras
+
+    @classmethod
+    def from_plist(cls, store, file_uuid, plist, keep_extras=False):
+        extras = None
+        if keep_extras:
+            extras = {k: v for k, v in plist.items() if k not in ITEM_FIELDS}
+        return cls(store, file_uuid, *item_fields(plist), extras=extras)
+
+    def __getitem__(self, name):
+        if name in ITEM_FIELDS:
+            value = getattr(self, name)
+            if value is None:
+                raise KeyError(name)
+            return value
+
+        return self.load_extras()[name]
+
+    def __setitem__(self, name, value):
+        if name in ITEM_FIELDS:
+            setattr(self, name, value)
+        else:
+            self.load_extras()[name] = value
+
+    def __iter__(self):
+        return iter(self.to_plist())
+
+    def __len__(self):
+        return len(self.to_plist())
+
+    def __repr__(self):
+        return f'ItemRecord({self.to_plist()!r})'
+
+    def load_extras(self):
+        if self.extras is None:
+            plist = self.store.load_plist(self.store.item_plist_path(self.file_uuid))
+            self.extras = {k: v for k, v in plist.items() if k not in ITEM_FIELDS}
+        return self.extras
+
+    # Returns the complete plist as a dict.
+    def to_plist(self):
+        plist = {}
+        for field in ITEM_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                plist[field] = value
+        plist.update(self.load_extras())
+        return plist
+
+
+# A least-recently-used cache of page bodies bounded by the total size of the
+# cached bodies rather than by the number of entries.
+class ItemCache:
+    def __init__(self, max_size=DEFAULT_ITEM_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, uuid):
+        entry = self.entries.get(uuid)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(uuid)
+        return entry[0]
+
+    def put(self, uuid, text, size):
+        self.discard(uuid)
+
+        # Do not let a single oversized body flush the whole cache.
+        if size > self.max_size:
+            return
+
+        self.entries[uuid] = (text, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def discard(self, uuid):
+        entry = self.entries.pop(uuid, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+
+# Adds many items to a DataStore at once. Names are checked for uniqueness
+# against the DataStore name index rather than by scanning every plist, pages
+# are written to disk whenever the buffered page text exceeds max_buffer
+# bytes, and properties.plist is only rewritten once, when the batch is
+# committed. Pages are readable through the DataStore as soon as they are
+# added: bodies not yet written are served from the batch buffer, and added
+# bodies go into ds.items (eager stores) or the item cache.
+class ItemBatch:
+    def __init__(self, ds, max_buffer=DEFAULT_BATCH_BUFFER_SIZE):
+        self.ds = ds
+        self.max_buffer = max_buffer
+        self.pending = []
+        self.pending_size = 0
+        self.uuids = []
+        ds.open_batches.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Pages that were accepted before an error are still written so the
+        # plists in memory, the files on disk and properties.plist agree.
+        self.commit()
+        return False
+
+    # Returns the UUID of the new item, or None if an item with the same name
+    # already exists.
+    def add(self, name, text, format):
+        if self.ds.find_by_name(name) is not None:
+            return None
+
+        plist = self.ds.new_item_record(name, text, format)
+        data = text.encode('utf-8')
+        item_uuid = plist['uuid']
+
+        self.ds.item_plists[item_uuid] = plist
+        self.ds.index_item(item_uuid, plist)
+        self.uuids.append(item_uuid)
+
+        if self.ds.eager:
+            self.ds.items[item_uuid] = text
+        else:
+            self.ds.item_cache.put(item_uuid, text, len(data))
+        self.ds.pending_bodies[item_uuid] = data
+
+        self.pending.append((plist, data))
+        self.pending_size += len(data)
+        if self.pending_size >= self.max_buffer:
+            self.flush()
+
+        return item_uuid
+
+    # Add every (name, text, format) tuple in items.
+    def add_items(self, items):
+        uuids = []
+        for name, text, format in items:
+            uuids.append(self.add(name, text, format))
+        return uuids
+
+    # Forget a page that was added to the batch but not written yet, so that
+    # deleting it before the batch is flushed does not write it back.
+    def discard(self, uuid):
+        for i, (plist, data) in enumerate(self.pending):
+            if plist['uuid'] == uuid:
+                del self.pending[i]
+                self.pending_size -= len(data)
+                break
+        self.ds.pending_bodies.pop(uuid, None)
+
+    def flush(self):
+        with self.ds.group_commit():
+            for plist, data in self.pending:
+                self.ds.save_item(plist, data)
+
+        for plist, _ in self.pending:
+            self.ds.pending_bodies.pop(plist['uuid'], None)
+        self.pending = []
+        self.pending_size = 0
+
+    def commit(self):
+        self.flush()
+        if self in self.ds.open_batches:
+            self.ds.open_batches.remove(self)
+
+        self.ds.properties['expectedPageCount'] = len(self.ds.item_plists)
+        self.ds.save_properties()
+
+
 class DataStore:
     def __init__(self):
         self.path = None
+        self.in_memory = False
         self.encrypted = False
         self.enc_ctx = None
         self.password = None
         self.storeinfo = {}
         self.properties = {}
+        self.eager = False
         self.items = {}
+        self.item_cache = ItemCache()
+        self.pending_bodies = {}
+        self.open_batches = []
         self.item_plists = {}
+        self.key_index = {}
+        self.name_index = {}
+        self.write_group = None
+        self.properties_changed = False
         self.trie = None
+        self.trie_saved = False
+        self.trie_snapshot = False
+        self.matcher = None
 
     @classmethod
     def create(cls, path):
@@ -96,13 +525,28 @@ class DataStore:
         storeinfo_path = Path(ds.path, 'storeinfo.plist')
         plistlib.dump(ds.storeinfo, open(str(storeinfo_path), 'wb'), fmt=plistlib.FMT_XML)
 
-        properties_path = Path(ds.path, 'properties.plist')
-        plistlib.dump(ds.properties, open(str(properties_path), 'wb'), fmt=plistlib.FMT_XML)
+        ds.save_properties()
 
         return ds
 
+    # By default page bodies are read from disk the first time item() asks
+    # for them and kept in a size-bounded LRU cache. Pass eager=True to read
+    # every page body into memory up front instead.
+    #
+    # If workers is greater than one the item plists (and, for eager opens,
+    # the page bodies) are parsed by a pool of that many worker processes,
+    # one pages/<hex> shard directory at a time.
+    #
+    # Unless the document is opened in memory, the parsed plists are recorded
+    # in a manifest (manifest.db, next to cache.db) and later opens only parse
+    # the plists that were added or changed since.
+    #
+    # A saved title trie snapshot is always used if it is current, but it is
+    # only written into the document when trie_snapshot is True (see
+    # title_trie()).
     @classmethod
-    def open(cls, path, password=None, in_memory=False):  # noqa: C901
+    def open(cls, path, password=None, in_memory=False, eager=False,
+             cache_size=DEFAULT_ITEM_CACHE_SIZE, workers=None, trie_snapshot=False):  # noqa: C901
         ds = cls()
 
         ds.path = Path(path)
@@ -110,6 +554,9 @@ class DataStore:
         ds.enc_ctx = None
         ds.password = password
         ds.in_memory = in_memory
+        ds.eager = eager
+        ds.trie_snapshot = trie_snapshot
+        ds.item_cache = ItemCache(cache_size)
 
         storeinfo_path = Path(ds.path, 'storeinfo.plist')
         if not storeinfo_path.exists():
@@ -142,87 +589,489 @@ class DataStore:
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), properties_path)
 
         ds.item_plists = {}
-        # item_plist_paths  = items_path.rglob('*.plist')
-        item_plist_paths = ds.get_plists(items_path)
+        ds.items = {}
+
+        if not ds.in_memory:
+            ds.load_items_with_manifest(items_path, workers)
+        elif workers is not None and workers > 1:
+            ds.load_items_parallel(items_path, workers)
+        else:
+            # item_plist_paths  = items_path.rglob('*.plist')
+            item_plist_paths = ds.get_plists(items_path)
+            for item_uuid, fields in ds.load_item_plists(item_plist_paths):
+                ds.item_plists[item_uuid] = ItemRecord(ds, item_uuid, *fields)
+
+        if ds.eager:
+            for item_uuid in ds.item_plists.keys():
+                if item_uuid in ds.items or not ds.has_body(item_uuid):
+                    continue
+
+                ds.items[item_uuid] = ds.load_item(item_uuid)
+
+        ds.rebuild_indexes()
+
+        return ds
+
+    def close(self):
+        pass
+
+    # Returns a list of (uuid, fields) tuples for the given plist paths, where
+    # fields are the values of ITEM_FIELDS.
+    def load_item_plists(self, item_plist_paths):
+        item_plists = []
         for item_plist_path in item_plist_paths:
             # VoodooPad (or the underlying macOS libraries) may generate
             # invalid XML. Skip the plist (and the associated item) if the XML
             # parser throws an exception.
             try:
                 item_uuid = item_plist_path.stem
-                item_plist = ds.load_plist(item_plist_path)
-                ds.item_plists[item_uuid] = item_plist
+                item_plist = self.load_plist(item_plist_path)
+                item_plists.append((item_uuid, item_fields(item_plist)))
             except xml.parsers.expat.ExpatError:
                 print(f'Skipping {item_uuid} due to invalid plist')
                 pass
 
-        ds.items = {}
-        for item_uuid in ds.item_plists.keys():
-            item_plist = ds.item_plist(item_uuid)
+        return item_plists
+
+    # Stat every plist with os.scandir() and only parse the ones whose stat
+    # signature does not match the manifest. Everything else is loaded from
+    # the manifest, and manifest entries for deleted plists are dropped.
+    def load_items_with_manifest(self, items_path, workers):
+        manifest = Manifest(self.path)
+        entries = manifest.entries()
+
+        # Plists that need to be parsed, grouped by shard.
+        stale = {}
+        signatures = {}
+
+        for shard in self.get_shards(items_path):
+            with os.scandir(str(shard)) as it:
+                shard_entries = sorted((e for e in it if e.name.endswith('.plist')), key=lambda e: e.name)
+
+            for entry in shard_entries:
+                item_uuid = entry.name[:-len('.plist')]
+                path = f'{shard.name}/{entry.name}'
+                signature = stat_signature(entry)
+
+                cached = entries.pop(path, None)
+                if cached is not None and cached[0] == signature:
+                    self.item_plists[item_uuid] = ItemRecord(self, item_uuid, *cached[1])
+                    continue
+
+                # Reserve the slot so item_plists stays in shard order.
+                self.item_plists[item_uuid] = None
+                stale.setdefault(shard, []).append(entry.name)
+                signatures[item_uuid] = (path, signature)
+
+        parsed = []
+        if workers is not None and workers > 1 and len(stale) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(load_shard, str(shard), False, names) for shard, names in stale.items()]
+                for future in futures:
+                    plists, _, skipped = future.result()
+                    for item_uuid in skipped:
+                        print(f'Skipping {item_uuid} due to invalid plist')
+                    parsed.extend(plists)
+        else:
+            for shard, names in stale.items():
+                parsed.extend(self.load_item_plists([Path(shard, name) for name in names]))
 
-            # If the current item is a page alias, then there is no file
-            # associated with it.  Skip it and move on to the next item.
-            if item_plist['uti'] in ['com.fm.page-alias']:
-                continue
+        changed = []
+        for item_uuid, fields in parsed:
+            self.item_plists[item_uuid] = ItemRecord(self, item_uuid, *fields)
+            path, signature = signatures.pop(item_uuid)
+            changed.append((path, signature, fields))
 
-            # If the current item is a file alias, skip it and move on to the
-            # next item.  The file alias is stored as an opaque blob created
-            # with [NSURL bookmarkDataWithOptions] which we cannot parse at
-            # this time.
-            if item_plist['uti'] in ['com.fm.file-alias']:
-                continue
+        # Whatever is left failed to parse.
+        for item_uuid in signatures:
+            del self.item_plists[item_uuid]
 
-            item_path = ds.item_path(item_uuid)
+        manifest.update(changed, list(entries.keys()))
+        manifest.close()
 
-            if not item_path.exists():
-                # FIXME: Raise an error that indicates the vpdoc is invalid or corrupt.
-                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), item_path)
+    # Parse the shard directories across a process pool. Results are merged
+    # in shard order (and in sorted order within each shard) so the contents
+    # and ordering of item_plists do not depend on which worker finishes first.
+    def load_items_parallel(self, items_path, workers):
+        shards = [str(shard) for shard in self.get_shards(items_path)]
 
-            ds.items[item_uuid] = ds.load_file(item_path).decode('utf-8')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(load_shard, shard, self.eager) for shard in shards]
 
-        return ds
+            for future in futures:
+                plists, bodies, skipped = future.result()
 
-    def close(self):
-        pass
+                for item_uuid in skipped:
+                    print(f'Skipping {item_uuid} due to invalid plist')
+
+                for item_uuid, fields in plists:
+                    self.item_plists[item_uuid] = ItemRecord(self, item_uuid, *fields)
+
+                self.items.update(bodies)
 
     def item_uuids(self):
         return self.item_plists.keys()
 
+    # Yields a (uuid, record, text) tuple for every item with a page body (or
+    # for the given uuids), in shard order. Bodies are read on a background
+    # thread up to read_ahead items ahead of the consumer and are not added
+    # to the item cache, so a pass over the whole document runs in memory
+    # bounded by read_ahead pages regardless of the document size.
+    def iter_items(self, uuids=None, read_ahead=DEFAULT_READ_AHEAD):
+        if uuids is None:
+            uuids = self.item_uuids()
+        uuids = sorted(uuid for uuid in uuids if self.has_body(uuid))
+
+        if self.eager:
+            for uuid in uuids:
+                yield uuid, self.item_plist(uuid), self.items[uuid]
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            remaining = iter(uuids)
+
+            for uuid in remaining:
+                pending.append((uuid, executor.submit(self.load_item, uuid)))
+                if len(pending) >= read_ahead:
+                    break
+
+            while pending:
+                uuid, future = pending.popleft()
+                for next_uuid in remaining:
+                    pending.append((next_uuid, executor.submit(self.load_item, next_uuid)))
+                    break
+                yield uuid, self.item_plist(uuid), future.result()
+
+    # Like iter_items(), but yields lists of up to size items at a time.
+    def iter_item_chunks(self, size, uuids=None, read_ahead=DEFAULT_READ_AHEAD):
+        chunk = []
+        for item in self.iter_items(uuids, max(read_ahead, size)):
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
     def item(self, uuid):
         # TODO: Should item() return the underlying item (e.g., if the uuid is an
         # alias) or should it return something else?
-        return self.items[uuid]
+        if self.eager:
+            return self.items[uuid]
+
+        text = self.item_cache.get(uuid)
+        if text is None:
+            if not self.has_body(uuid):
+                raise KeyError(uuid)
+            data = self.pending_bodies.get(uuid)
+            if data is None:
+                data = self.load_file(self.checked_item_path(uuid))
+            text = data.decode('utf-8')
+            self.item_cache.put(uuid, text, len(data))
+
+        return text
+
+    # Returns True if the item has a page body on disk. Page aliases have no
+    # file associated with them, and file aliases are stored as an opaque blob
+    # created with [NSURL bookmarkDataWithOptions] which we cannot parse at
+    # this time.
+    def has_body(self, uuid):
+        return self.item_plist(uuid)['uti'] not in ALIAS_UTIS
+
+    # Returns a context manager giving a read-only memoryview of the UTF-8
+    # page body. The body is memory-mapped rather than read, so large pages
+    # can be hashed and tokenized without holding a copy of them in memory.
+    # The view is only valid inside the with block.
+    @contextlib.contextmanager
+    def item_view(self, uuid):
+        if not self.has_body(uuid):
+            raise KeyError(uuid)
+
+        # Pages added in a batch that has not been written yet.
+        data = self.pending_bodies.get(uuid)
+        if data is not None:
+            yield memoryview(data)
+            return
+
+        item_path = self.checked_item_path(uuid)
+
+        if self.encrypted:
+            yield memoryview(self.load_file(item_path))
+            return
+
+        with open(str(item_path), 'rb') as fp:
+            # Empty files cannot be memory-mapped.
+            if os.fstat(fp.fileno()).st_size == 0:
+                yield memoryview(b'')
+                return
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    yield view
+                finally:
+                    view.release()
+
+    def load_item(self, uuid):
+        data = self.pending_bodies.get(uuid)
+        if data is None:
+            data = self.load_file(self.checked_item_path(uuid))
+        return data.decode('utf-8')
+
+    def checked_item_path(self, uuid):
+        item_path = self.item_path(uuid)
+
+        if not item_path.exists():
+            # FIXME: Raise an error that indicates the vpdoc is invalid or corrupt.
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), item_path)
+
+        return item_path
+
+    def item_cache_stats(self):
+        return self.item_cache.stats()
 
     def item_plist(self, uuid):
         return self.item_plists[uuid]
 
+    # Returns the UUID of the item with the given key, or None.
+    def find_by_key(self, key):
+        return self.key_index.get(key)
+
+    # Returns the UUID of the item whose display name matches the given name
+    # (ignoring case), or None.
+    def find_by_name(self, name):
+        return self.name_index.get(normalize_name(name))
+
+    # The key and name indexes map to the first item with a given key or
+    # name, so items are indexed in item_plists order.
+    def rebuild_indexes(self):
+        self.key_index = {}
+        self.name_index = {}
+        self.trie = None
+        self.trie_saved = False
+        self.matcher = None
+        for item_uuid, item_plist in self.item_plists.items():
+            self.index_item(item_uuid, item_plist)
+
+    # Add an item to the indexes, and to the title trie if it has been built.
+    def index_item(self, uuid, plist):
+        self.key_index.setdefault(plist['key'], uuid)
+        self.name_index.setdefault(normalize_name(plist['displayName']), uuid)
+
+        if self.trie is not None:
+            self.trie.add(title_words(plist['displayName']))
+            self.trie_saved = False
+            self.matcher = None
+
+    # Remove an item from the indexes. This must be called with the item's
+    # plist as it was indexed, before the item is deleted or renamed.
+    def unindex_item(self, uuid, plist):
+        key = plist['key']
+        if self.key_index.get(key) == uuid:
+            del self.key_index[key]
+
+        name = normalize_name(plist['displayName'])
+        if self.name_index.get(name) == uuid:
+            del self.name_index[name]
+
+        if self.trie is not None:
+            self.trie.remove(title_words(plist['displayName']))
+            self.trie_saved = False
+            self.matcher = None
+
     def item_path(self, uuid):
         return Path(self.path, 'pages', uuid[0], uuid)
 
     def item_plist_path(self, uuid):
         return Path(self.path, 'pages', uuid[0], '{}.plist'.format(uuid))
 
-    def validate(self):
-        valid = True
+    def validate(self, workers=None, progress=None, incremental=False, hash_bodies=True):
+        report = self.check(workers, progress, incremental, hash_bodies)
+
+        for issue in report.issues:
+            print('[WARN] {}'.format(issue['message']))
+
+        return report.valid
+
+    # Check the integrity of the document and return a ValidationReport.
+    #
+    # Page bodies are hashed on a pool of workers threads and compared with
+    # the dataHash in their plists. progress, if given, is called with the
+    # number of bodies hashed so far and the total. If incremental is True,
+    # only pages whose body or plist was modified since the last check that
+    # found no problems are hashed; the other checks are cheap and always run.
+    # If hash_bodies is False no page body is read at all, and only the
+    # structural checks run. Such a check is not recorded in manifest.db.
+    def check(self, workers=None, progress=None, incremental=False, hash_bodies=True):  # noqa: C901
+        report = ValidationReport()
+        started_ns = time.time_ns()
+
+        manifest = None
+        if hash_bodies and not self.in_memory:
+            manifest = Manifest(self.path)
+
+        since_ns = 0
+        if incremental and manifest is not None:
+            since_ns = manifest.get_value('last_clean_check_ns', 0)
 
         # Validate that the UUIDs match the UUIDs stored in the property lists.
         for item_uuid in self.item_uuids():
             item_plist = self.item_plist(item_uuid)
             if item_uuid != item_plist['uuid']:
-                valid = False
-                print('[WARN] UUID mismatch for {}'.format(item_uuid))
+                report.add('uuid-mismatch', item_uuid, 'UUID mismatch for {}'.format(item_uuid))
+
+        # Check that every page body has a plist and every plist (other than
+        # an alias) has a page body.
+        bodies = {}
+        plists = {}
+        for shard in self.get_shards(Path(self.path, 'pages')):
+            with os.scandir(str(shard)) as it:
+                for entry in it:
+                    # Skip temporary files left by interrupted writes.
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.name.endswith('.plist'):
+                        plists[entry.name[:-len('.plist')]] = entry
+                    else:
+                        bodies[entry.name] = entry
+
+        for item_uuid in sorted(bodies.keys()):
+            if item_uuid not in self.item_plists:
+                report.add('orphan-body', item_uuid, 'Page body {} has no plist'.format(item_uuid))
+
+        to_hash = []
+        for item_uuid in self.item_uuids():
+            if not self.has_body(item_uuid):
+                continue
+
+            entry = bodies.get(item_uuid)
+            if entry is None:
+                report.add('missing-body', item_uuid, 'Page body for {} is missing'.format(item_uuid))
+                continue
 
-        # TODO: Check the default item exists.
+            if not hash_bodies:
+                continue
+
+            # The plist holds the dataHash the body is checked against, so a
+            # page is only skipped if neither file has changed.
+            plist_entry = plists.get(item_uuid)
+            if (entry.stat().st_mtime_ns < since_ns and plist_entry is not None
+                    and plist_entry.stat().st_mtime_ns < since_ns):
+                report.skipped += 1
+                continue
+
+            to_hash.append(item_uuid)
+
+        # Check the page bodies match their hashes.
+        def hash_item(item_uuid):
+            if self.encrypted:
+                return sha1_hash(self.load_item(item_uuid))
+            return sha1_file(self.item_path(item_uuid))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for item_uuid, data_hash in zip(to_hash, executor.map(hash_item, to_hash)):
+                expected = self.item_plist(item_uuid).get('dataHash')
+                if expected is not None and expected != data_hash:
+                    report.add('hash-mismatch', item_uuid, 'dataHash mismatch for {}'.format(item_uuid))
+
+                report.hashed += 1
+                if progress is not None:
+                    progress(report.hashed, len(to_hash))
+
+        # Check the default item exists.
+        default_uuid = self.properties.get('defaultUUID')
+        if default_uuid is not None and default_uuid not in self.item_plists:
+            report.add('missing-default', default_uuid, 'Default page {} does not exist'.format(default_uuid))
+
+        # Check the expected item count matches the actual item count.
+        expected_count = self.properties.get('expectedPageCount')
+        if expected_count is not None and int(expected_count) != len(self.item_plists):
+            report.add('page-count', None, 'Expected {} pages but found {}'.format(expected_count, len(self.item_plists)))
 
-        # TODO: Check the expected item count matches the actual item count.
+        # TODO: Check that alias targets exist. Nothing in this tree reads page
+        # alias plists yet, so where an alias records its target is unknown.
 
-        # TODO: Check that alias targets exist.
+        if manifest is not None:
+            if report.valid:
+                manifest.set_value('last_clean_check_ns', started_ns)
+            manifest.close()
 
-        return valid
+        return report
 
     def add_item(self, name, text, format):
+        pl = self.new_item_record(name, text, format)
+        item_uuid = pl['uuid']
+
+        data = text.encode('utf-8')
+
+        # Save to disk
+        self.save_item(pl, data)
+
+        # Keep in memory
+        if self.eager:
+            self.items[item_uuid] = text
+        else:
+            self.item_cache.put(item_uuid, text, len(data))
+        self.item_plists[item_uuid] = pl
+        self.index_item(item_uuid, pl)
+
+        self.properties['expectedPageCount'] = len(self.item_plists)
+        self.update_properties()
+
+        return item_uuid
+
+    # Delete the item and its page body.
+    def delete_item(self, uuid):
+        plist = self.item_plist(uuid)
+        self.unindex_item(uuid, plist)
+
+        for batch in self.open_batches:
+            batch.discard(uuid)
+
+        with self.group_commit():
+            if self.has_body(uuid) and self.item_path(uuid).exists():
+                self.remove_atomic(self.item_path(uuid))
+            self.remove_atomic(self.item_plist_path(uuid))
+
+        del self.item_plists[uuid]
+        self.items.pop(uuid, None)
+        self.item_cache.discard(uuid)
+
+        self.properties['expectedPageCount'] = len(self.item_plists)
+        self.update_properties()
+
+    # Give the item a new name. Returns False if another item already has
+    # that name.
+    def rename_item(self, uuid, name):
+        existing = self.find_by_name(name)
+        if existing is not None and existing != uuid:
+            return False
+
+        plist = self.item_plist(uuid)
+        self.unindex_item(uuid, plist)
+
+        plist['displayName'] = name
+        plist['key'] = normalize_name(name)
+        self.save_plist(plist, self.item_plist_path(uuid))
+
+        self.index_item(uuid, plist)
+
+        return True
+
+    # Returns a context manager for adding many items at once. See ItemBatch.
+    def batch(self, max_buffer=DEFAULT_BATCH_BUFFER_SIZE):
+        return ItemBatch(self, max_buffer)
+
+    # Add every (name, text, format) tuple in items in a single batch.
+    def add_items(self, items):
+        with self.batch() as batch:
+            return batch.add_items(items)
+
+    def new_item_plist(self, name, text, format):
         item_uuid = str(UUID.uuid4())
-        item_key = name.lower()
+        item_key = normalize_name(name)
 
         data_hash = sha1_hash(text)
 
@@ -235,18 +1084,80 @@ class DataStore:
           dataHash = data_hash
         )
 
-        item_path = Path(self.path, 'pages', item_uuid[0], item_uuid)
-        plist_path = Path(self.path, 'pages', item_uuid[0], item_uuid + '.plist')
+        return pl
 
-        # Save to disk
-        self.save_plist(pl, plist_path)
-        self.save_file(text.encode('utf-8'), item_path)
+    def new_item_record(self, name, text, format):
+        pl = self.new_item_plist(name, text, format)
+        return ItemRecord.from_plist(self, pl['uuid'], pl, keep_extras=True)
 
-        # Keep in memory
-        self.items[item_uuid] = text
-        self.item_plists[item_uuid] = pl
+    def save_item(self, plist, data):
+        item_uuid = plist['uuid']
 
-        return item_uuid
+        self.save_plist(plist, self.item_plist_path(item_uuid))
+        self.save_file(data, self.item_path(item_uuid))
+
+    def save_properties(self):
+        properties_path = Path(self.path, 'properties.plist')
+        self.save_plist(self.properties, properties_path)
+
+    # Save properties.plist now, or once when the current group commit exits.
+    def update_properties(self):
+        if self.write_group is not None:
+            self.properties_changed = True
+        else:
+            self.save_properties()
+
+    # Every file is saved by writing a temporary file in the same directory
+    # and renaming it over the original, so a crash never leaves a partially
+    # written file behind. Outside of a group commit each save is flushed to
+    # disk on its own. Inside a group commit the renames, removals and flushes
+    # are deferred until the group exits and issued once for the whole group,
+    # and properties.plist is written at most once.
+    @contextlib.contextmanager
+    def group_commit(self):
+        if self.write_group is not None:
+            yield
+            return
+
+        self.write_group = []
+        try:
+            yield
+        finally:
+            if self.properties_changed:
+                self.properties_changed = False
+                self.save_properties()
+            pending = self.write_group
+            self.write_group = None
+            commit_writes(pending)
+
+    # Write data to a temporary file next to path and commit it (or add it to
+    # the current group commit).
+    def write_atomic(self, data, path):
+        directory, name = os.path.split(str(path))
+
+        # Unlike tempfile.mkstemp(), this creates the file with the usual
+        # permissions (subject to the umask).
+        tmp_path = os.path.join(directory, f'.{name}.{UUID.uuid4().hex}.tmp')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self.write_group is not None:
+            self.write_group.append((tmp_path, path))
+        else:
+            commit_writes([(tmp_path, path)])
+
+    # Remove path and flush its directory (or add the removal to the current
+    # group commit).
+    def remove_atomic(self, path):
+        if self.write_group is not None:
+            self.write_group.append((None, path))
+        else:
+            commit_writes([(None, path)])
 
     def load_plist(self, path):
         if self.encrypted:
@@ -255,12 +1166,14 @@ class DataStore:
             return plistlib.load(open(str(path), 'rb'), fmt=plistlib.FMT_XML)
 
     def save_plist(self, plist, path):
+        if isinstance(plist, ItemRecord):
+            plist = plist.to_plist()
+
         os.makedirs(os.path.dirname(path), exist_ok=True)
         if self.encrypted:
             return self.enc_ctx.save_plist(plist, path)
         else:
-            with open(path, 'wb') as fp:
-                plistlib.dump(plist, fp)
+            self.write_atomic(plistlib.dumps(plist), path)
 
     def load_file(self, path):
         if self.encrypted:
@@ -273,30 +1186,91 @@ class DataStore:
         if self.encrypted:
             self.enc_ctx.save_file(path, data)
         else:
-            with open(path, 'wb') as fp:
-                fp.write(data)
+            self.write_atomic(data, path)
 
     # This is a work-around for Path.rglob('*.plist'). Path.rglob() has issues when running inside
     # Geekbench
     def get_plists(self, dir):
-        subdirs = os.listdir(str(dir))
         plists = []
-        for s in subdirs:
-            path = str(Path(dir, s))
-
-            if not os.path.isdir(path):
-                continue
-
-            entries = os.listdir(path)
+        for path in self.get_shards(dir):
+            entries = sorted(os.listdir(str(path)))
             for e in entries:
                 if e.endswith('.plist'):
                     plists.append(Path(path, e))
 
         return plists
 
+    # Returns the pages/<hex> shard directories in sorted order.
+    def get_shards(self, dir):
+        shards = []
+        for s in sorted(os.listdir(str(dir))):
+            path = Path(dir, s)
+            if os.path.isdir(str(path)):
+                shards.append(path)
+
+        return shards
+
     def regenerate_trie(self):
         self.trie = WordTrie()
+        self.matcher = None
         for uuid in self.item_uuids():
             item = self.item_plist(uuid)
-            name = tokenizer.tokenize_text(item['displayName'].lower())
-            self.trie.add(name)
+            self.trie.add(title_words(item['displayName']))
+
+    # Returns the trie of page names. The trie is loaded from the snapshot
+    # (see save_title_trie()) or built the first time it is needed, and then
+    # kept up to date as items are added, renamed and deleted. A trie that
+    # had to be built is saved straight away if the store was opened with
+    # trie_snapshot=True.
+    def title_trie(self):
+        if self.trie is None:
+            self.trie = self.load_title_trie()
+            self.trie_saved = self.trie is not None
+            if self.trie is None:
+                self.regenerate_trie()
+                if self.trie_snapshot:
+                    self.save_title_trie()
+        return self.trie
+
+    # Returns a hash of the names of every item, as the tag of the trie
+    # snapshot. It changes whenever a page is added, renamed or deleted.
+    def title_set_hash(self):
+        names = sorted(plist['displayName'] for plist in self.item_plists.values())
+        return hashlib.sha1('\n'.join(names).encode('utf-8')).digest()
+
+    def title_trie_path(self):
+        return Path(self.path, TRIE_SNAPSHOT_NAME)
+
+    # Load the trie snapshot if it was saved for the current set of names.
+    # Returns None otherwise. The snapshot is memory-mapped, and its arrays
+    # are copied out of the mapping in a few bulk operations.
+    def load_title_trie(self):
+        if self.in_memory or self.encrypted:
+            return None
+
+        try:
+            with open(str(self.title_trie_path()), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    return WordTrie.from_snapshot(buffer, self.title_set_hash(), TITLE_WORDS_VERSION)
+        except (OSError, ValueError):
+            # A missing or empty snapshot.
+            return None
+
+    # Save the title trie to a snapshot next to cache.db, unless the snapshot
+    # is already up to date. Documents opened in memory and encrypted
+    # documents (whose page names would be written in the clear) have no
+    # snapshot.
+    def save_title_trie(self):
+        if self.trie is None or self.trie_saved or self.in_memory or self.encrypted:
+            return
+
+        snapshot = self.trie.to_snapshot(self.title_set_hash(), TITLE_WORDS_VERSION)
+        self.write_atomic(snapshot, self.title_trie_path())
+        self.trie_saved = True
+
+    # Returns a WordMatcher for the page names in the trie, compiling it the
+    # first time it is needed after the trie changes.
+    def title_matcher(self):
+        if self.matcher is None:
+            self.matcher = WordMatcher(self.title_trie())
+        return self.matcher
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from datastore import TITLE_WORDS_VERSION, DataStore, ItemCache, normalize_name, sha1_hash, title_words
+from tokenizer import VPItem
+from utility import is_unreadable_database, remove_database
+
+
+class DataStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'Test.vpdoc')
+
+        ds = DataStore.create(self.path)
+        self.apple = ds.add_item('Apple', 'Apple makes computers', 'net.daringfireball.markdown')
+        self.atari = ds.add_item('Atari', 'Atari makes computers too', 'net.daringfireball.markdown')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lazy_open(self):
+        ds = DataStore.open(self.path)
+        self.assertEqual(len(ds.items), 0)
+
+        self.assertEqual(ds.item(self.apple), 'Apple makes computers')
+        self.assertEqual(ds.item(self.apple), 'Apple makes computers')
+
+        stats = ds.item_cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_eager_open(self):
+        ds = DataStore.open(self.path, eager=True)
+        self.assertEqual(len(ds.items), 3)
+        self.assertEqual(ds.item(self.atari), 'Atari makes computers too')
+
+    def test_parallel_open(self):
+        serial = DataStore.open(self.path, in_memory=True, eager=True)
+        parallel = DataStore.open(self.path, in_memory=True, eager=True, workers=2)
+
+        self.assertEqual(list(parallel.item_uuids()), list(serial.item_uuids()))
+        self.assertEqual(parallel.items, serial.items)
+
+    def test_manifest(self):
+        ds = DataStore.open(self.path)
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'manifest.db')))
+        self.assertEqual(ds.item_plist(self.apple)['displayName'], 'Apple')
+
+        # Change one plist and delete another behind the manifest's back.
+        plist = ds.item_plist(self.apple)
+        plist['displayName'] = 'Apple Computer'
+        ds.save_plist(plist, ds.item_plist_path(self.apple))
+        os.remove(ds.item_plist_path(self.atari))
+
+        ds = DataStore.open(self.path)
+        self.assertEqual(ds.item_plist(self.apple)['displayName'], 'Apple Computer')
+        self.assertNotIn(self.atari, ds.item_uuids())
+        self.assertEqual(len(ds.item_plists), 2)
+
+    def test_damaged_manifest(self):
+        manifest_path = os.path.join(self.path, 'manifest.db')
+        DataStore.open(self.path)
+
+        # A manifest that is not a database is rebuilt from the plists, and
+        # journal files left next to it are thrown away with it.
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            with open(manifest_path + suffix, 'wb') as f:
+                f.write(b'not a database' * 100)
+        ds = DataStore.open(self.path)
+        self.assertEqual(ds.item_plist(self.apple)['displayName'], 'Apple')
+        for suffix in ('-journal', '-wal', '-shm'):
+            if os.path.exists(manifest_path + suffix):
+                with open(manifest_path + suffix, 'rb') as f:
+                    self.assertFalse(f.read().startswith(b'not a database'))
+        self.assertEqual(DataStore.open(self.path).item_plist(self.atari)['displayName'], 'Atari')
+
+        # Errors such as a locked database are not mistaken for damage.
+        self.assertFalse(is_unreadable_database(sqlite3.OperationalError('database is locked')))
+        self.assertTrue(is_unreadable_database(sqlite3.DatabaseError('file is not a database')))
+
+        # Removing the manifest also removes its journal files.
+        DataStore.open(self.path).close()
+        for suffix in ('-journal', '-wal', '-shm'):
+            with open(manifest_path + suffix, 'wb') as f:
+                f.write(b'stale')
+        remove_database(manifest_path)
+        self.assertEqual([name for name in os.listdir(self.path) if name.startswith('manifest.db')], [])
+
+    def test_batch(self):
+        ds = DataStore.open(self.path)
+
+        # Duplicates are skipped quietly; reporting them is up to the caller.
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), ds.batch(max_buffer=16) as batch:
+            uuids = batch.add_items([
+                ('Commodore', 'Commodore made the Amiga', 'net.daringfireball.markdown'),
+                ('apple', 'Duplicate name', 'net.daringfireball.markdown'),
+                ('Amiga', 'The Amiga was a computer', 'net.daringfireball.markdown'),
+                ('AMIGA', 'Duplicate name inside the batch', 'net.daringfireball.markdown'),
+            ])
+
+        self.assertIsNotNone(uuids[0])
+        self.assertIsNone(uuids[1])
+        self.assertIsNotNone(uuids[2])
+        self.assertIsNone(uuids[3])
+        self.assertEqual(output.getvalue(), '')
+
+        ds = DataStore.open(self.path)
+        self.assertEqual(len(ds.item_plists), 5)
+        self.assertEqual(ds.properties['expectedPageCount'], 5)
+        self.assertEqual(ds.item(uuids[2]), 'The Amiga was a computer')
+
+    def test_batch_eager(self):
+        ds = DataStore.open(self.path, eager=True)
+
+        with ds.batch() as batch:
+            commodore = batch.add('Commodore', 'Commodore made the Amiga', 'net.daringfireball.markdown')
+
+        self.assertEqual(ds.item(commodore), 'Commodore made the Amiga')
+        items = {uuid: text for uuid, _, text in ds.iter_items()}
+        self.assertEqual(items[commodore], 'Commodore made the Amiga')
+        self.assertEqual(items[self.apple], 'Apple makes computers')
+
+    def test_batch_read_before_flush(self):
+        ds = DataStore.open(self.path)
+
+        with ds.batch() as batch:
+            commodore = batch.add('Commodore', 'Commodore made the Amiga', 'net.daringfireball.markdown')
+            self.assertFalse(os.path.exists(ds.item_path(commodore)))
+
+            ds.item_cache.clear()
+            self.assertEqual(ds.item(commodore), 'Commodore made the Amiga')
+            self.assertEqual(ds.load_item(commodore), 'Commodore made the Amiga')
+            with ds.item_view(commodore) as view:
+                self.assertEqual(bytes(view), b'Commodore made the Amiga')
+            items = {uuid: text for uuid, _, text in ds.iter_items()}
+            self.assertEqual(items[commodore], 'Commodore made the Amiga')
+
+        self.assertEqual(ds.pending_bodies, {})
+        self.assertTrue(os.path.exists(ds.item_path(commodore)))
+        self.assertEqual(DataStore.open(self.path).item(commodore), 'Commodore made the Amiga')
+
+    def test_batch_delete_before_flush(self):
+        ds = DataStore.open(self.path)
+
+        with ds.batch() as batch:
+            gone = batch.add('Gone', 'Deleted before it was written', 'net.daringfireball.markdown')
+            ds.delete_item(gone)
+
+        self.assertFalse(os.path.exists(ds.item_path(gone)))
+        self.assertFalse(os.path.exists(ds.item_plist_path(gone)))
+        self.assertEqual(ds.open_batches, [])
+
+        ds = DataStore.open(self.path)
+        self.assertNotIn(gone, ds.item_uuids())
+        self.assertEqual(ds.properties['expectedPageCount'], 3)
+
+    def test_find_by_name(self):
+        ds = DataStore.open(self.path)
+        self.assertEqual(ds.find_by_name('APPLE'), self.apple)
+        self.assertEqual(ds.find_by_key('atari'), self.atari)
+        self.assertIsNone(ds.find_by_name('Commodore'))
+
+        commodore = ds.add_item('Commodore', 'Commodore made the Amiga', 'net.daringfireball.markdown')
+        self.assertEqual(ds.find_by_name('commodore'), commodore)
+        self.assertEqual(ds.find_by_key('commodore'), commodore)
+
+        ds.unindex_item(commodore, ds.item_plist(commodore))
+        self.assertIsNone(ds.find_by_name('Commodore'))
+
+        # Names, keys and title words fold case the same way, so a name that
+        # is taken is also the key of the page it links to.
+        strasse = ds.add_item('Straße', 'A street', 'net.daringfireball.markdown')
+        self.assertIsNone(ds.find_by_name('STRASSE'))
+        self.assertEqual(ds.find_by_name('STRAßE'), strasse)
+        self.assertEqual(ds.find_by_key(normalize_name('STRAßE')), strasse)
+        self.assertEqual(title_words('STRAßE'), [ds.item_plist(strasse)['key']])
+
+    def test_title_trie(self):
+        ds = DataStore.open(self.path)
+        trie = ds.title_trie()
+        self.assertEqual(trie.query(['apple']).words, 1)
+
+        # The trie follows adds, renames and deletes without being rebuilt.
+        commodore = ds.add_item('Commodore Amiga', 'Made by Commodore', 'net.daringfireball.markdown')
+        self.assertEqual(trie.query(['commodore', 'amiga']).words, 1)
+
+        ds.rename_item(commodore, 'Amiga')
+        self.assertIsNone(trie.query(['commodore']))
+        self.assertEqual(trie.query(['amiga']).words, 1)
+
+        ds.delete_item(self.apple)
+        self.assertIsNone(trie.query(['apple']))
+        self.assertIs(ds.title_trie(), trie)
+
+    def test_title_matcher(self):
+        ds = DataStore.open(self.path)
+        ds.add_item('Atari Falcon', 'Made by Atari', 'net.daringfireball.markdown')
+        text = 'The Atari Falcon and the Apple IIgs ran on Motorola chips, like the Commodore Amiga.'
+
+        def keywords(matcher):
+            return VPItem(text, ds.title_trie(), matcher=matcher).item_keywords()
+
+        self.assertEqual(keywords(ds.title_matcher()), keywords(None))
+        self.assertIs(ds.title_matcher(), ds.title_matcher())
+
+        # Changing the titles compiles a new matcher from the updated trie.
+        ds.add_item('Commodore Amiga', 'Made by Commodore', 'net.daringfireball.markdown')
+        self.assertIn('commodore amiga', keywords(ds.title_matcher()))
+        self.assertEqual(keywords(ds.title_matcher()), keywords(None))
+
+    def test_title_trie_snapshot(self):
+        snapshot = os.path.join(self.path, 'trie.bin')
+
+        # By default the snapshot is not written into the document.
+        DataStore.open(self.path).title_trie()
+        self.assertFalse(os.path.exists(snapshot))
+
+        ds = DataStore.open(self.path, trie_snapshot=True)
+        trie = ds.title_trie()
+        self.assertTrue(os.path.isfile(snapshot))
+
+        # The next open loads the snapshot.
+        ds = DataStore.open(self.path)
+        loaded = ds.load_title_trie()
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.word_list, trie.word_list)
+        self.assertEqual(loaded.edge_keys, trie.edge_keys)
+        self.assertEqual(loaded.edge_children, trie.edge_children)
+        self.assertEqual(loaded.query(['atari']).words, 1)
+
+        # Changing the titles makes the snapshot stale until it is saved.
+        ds.title_trie()
+        ds.add_item('Commodore', 'Commodore made the Amiga', 'net.daringfireball.markdown')
+        self.assertIsNone(DataStore.open(self.path).load_title_trie())
+        ds.save_title_trie()
+
+        ds = DataStore.open(self.path)
+        self.assertEqual(ds.load_title_trie().query(['commodore']).words, 1)
+
+        # A snapshot from another version of title_words() is not used.
+        with open(snapshot, 'rb') as f:
+            data = f.read()
+        with open(snapshot, 'wb') as f:
+            f.write(ds.title_trie().to_snapshot(ds.title_set_hash(), TITLE_WORDS_VERSION + 1))
+        self.assertIsNone(DataStore.open(self.path).load_title_trie())
+
+        # A damaged snapshot is rebuilt.
+        with open(snapshot, 'wb') as f:
+            f.write(data[:100])
+        ds = DataStore.open(self.path, trie_snapshot=True)
+        self.assertIsNone(ds.load_title_trie())
+        self.assertEqual(ds.title_trie().query(['commodore']).words, 1)
+        self.assertIsNotNone(DataStore.open(self.path).load_title_trie())
+
+    def test_item_record(self):
+        ds = DataStore.open('documents/Empty.vpdoc', in_memory=True)
+
+        record = ds.item_plist('15cd7cb7-29f3-4ee8-9d88-d74ef0b2905a')
+        self.assertEqual(record['displayName'], 'Index')
+        self.assertIsNone(record.extras)
+
+        # Fields other than the core fields are read from disk on demand.
+        self.assertEqual(record['attributes']['lastEditingUserName'], 'brichard')
+        self.assertEqual(record.get('version'), 1)
+        self.assertIsNone(record.get('missing'))
+
+    def test_iter_items(self):
+        ds = DataStore.open(self.path)
+
+        items = list(ds.iter_items(read_ahead=1))
+        self.assertEqual([uuid for uuid, _, _ in items], sorted(ds.item_uuids()))
+
+        texts = {uuid: text for uuid, _, text in items}
+        self.assertEqual(texts[self.apple], 'Apple makes computers')
+        self.assertEqual(ds.item_cache_stats()['misses'], 0)
+
+        chunks = list(ds.iter_item_chunks(2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+
+    def test_item_view(self):
+        ds = DataStore.open(self.path)
+
+        with ds.item_view(self.apple) as view:
+            self.assertEqual(bytes(view), b'Apple makes computers')
+            self.assertEqual(sha1_hash(view), ds.item_plist(self.apple)['dataHash'])
+
+        empty = ds.add_item('Empty', '', 'net.daringfireball.markdown')
+        with ds.item_view(empty) as view:
+            self.assertEqual(len(view), 0)
+
+    def test_check(self):
+        ds = DataStore.open(self.path)
+        report = ds.check(workers=2)
+        self.assertTrue(report.valid)
+        self.assertEqual(report.hashed, 3)
+
+        # Corrupt one body and delete another.
+        ds.save_file(b'Apple makes phones', ds.item_path(self.apple))
+        os.remove(ds.item_path(self.atari))
+
+        report = ds.check(incremental=True)
+        kinds = sorted(issue['kind'] for issue in report.issues)
+        self.assertEqual(kinds, ['hash-mismatch', 'missing-body'])
+
+        # An incremental check after a clean run skips unmodified bodies.
+        ds.save_file(b'Apple makes computers', ds.item_path(self.apple))
+        ds.save_file(b'Atari makes computers too', ds.item_path(self.atari))
+        self.assertTrue(ds.check().valid)
+        report = ds.check(incremental=True)
+        self.assertTrue(report.valid)
+        self.assertEqual(report.hashed, 0)
+        self.assertEqual(report.skipped, 3)
+
+        # Changing a plist makes its page be hashed again.
+        plist = ds.item_plist(self.atari)
+        plist['dataHash'] = sha1_hash('Atari makes consoles')
+        ds.save_plist(plist, ds.item_plist_path(self.atari))
+        report = ds.check(incremental=True)
+        self.assertEqual(report.hashed, 1)
+        self.assertEqual([issue['kind'] for issue in report.issues], ['hash-mismatch'])
+
+        # A structural check reads no page bodies and is not recorded.
+        os.remove(ds.item_path(self.apple))
+        report = ds.check(hash_bodies=False)
+        self.assertEqual(report.hashed, 0)
+        self.assertEqual([issue['kind'] for issue in report.issues], ['missing-body'])
+
+        plist['dataHash'] = sha1_hash('Atari makes computers too')
+        ds.save_plist(plist, ds.item_plist_path(self.atari))
+        ds.save_file(b'Apple makes computers', ds.item_path(self.apple))
+        self.assertTrue(ds.check(hash_bodies=False).valid)
+        self.assertEqual(ds.check(incremental=True).hashed, 2)
+
+    def test_group_properties(self):
+        ds = DataStore.open(self.path)
+        saves = []
+        save_properties = ds.save_properties
+        ds.save_properties = lambda: saves.append(save_properties())
+
+        with ds.group_commit():
+            ds.add_item('Commodore', 'Commodore made the Amiga', 'net.daringfireball.markdown')
+            ds.add_item('Amiga', 'The Amiga was a computer', 'net.daringfireball.markdown')
+            ds.delete_item(self.apple)
+
+        self.assertEqual(len(saves), 1)
+        self.assertEqual(DataStore.open(self.path).properties['expectedPageCount'], 4)
+
+    def test_group_commit(self):
+        ds = DataStore.open(self.path)
+        path = os.path.join(self.path, 'pages', 'test')
+
+        with ds.group_commit():
+            ds.save_file(b'hello', path)
+            ds.save_file(b'hello world', path + '.plist')
+
+            # Nothing is visible until the group commits.
+            self.assertFalse(os.path.exists(path))
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'hello')
+        with open(path + '.plist', 'rb') as f:
+            self.assertEqual(f.read(), b'hello world')
+        self.assertEqual([e for e in os.listdir(os.path.dirname(path)) if e.endswith('.tmp')], [])
+
+        # Deletes are deferred the same way.
+        body_path = ds.item_path(self.atari)
+        with ds.group_commit():
+            ds.delete_item(self.atari)
+            self.assertTrue(os.path.exists(body_path))
+            self.assertTrue(os.path.exists(ds.item_plist_path(self.atari)))
+
+        self.assertFalse(os.path.exists(body_path))
+        self.assertFalse(os.path.exists(ds.item_plist_path(self.atari)))
+        self.assertNotIn(self.atari, DataStore.open(self.path).item_uuids())
+
+    def test_item_cache_eviction(self):
+        cache = ItemCache(10)
+        cache.put('a', 'aaaa', 4)
+        cache.put('b', 'bbbb', 4)
+        self.assertEqual(cache.get('a'), 'aaaa')
+
+        # Adding 'c' evicts 'b', the least recently used entry.
+        cache.put('c', 'cccc', 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from array import array
+import itertools
+
+
+# The link graph of a document in compressed sparse row (CSR) form. Pages are
+# numbered 0 to n - 1 and the links of page v are the page numbers
+# targets[offsets[v]:offsets[v + 1]], sorted. Both are flat machine-word
+# arrays, so a graph takes about 4 bytes per link and 8 bytes per page, plus
+# the page UUIDs and names. The reverse graph (the backlinks of every page)
+# is built on first use.
+class LinkGraph:
+    def __init__(self, uuids, names, offsets, targets):
+        self.uuids = uuids
+        self.names = names
+        self.offsets = offsets
+        self.targets = targets
+        self.ids = {uuid: v for v, uuid in enumerate(uuids)}
+        self.reverse_ = None
+
+    # Load the graph from a VPCache. Each keyword a page links to becomes one
+    # edge, to the same page VPCache.get_forwardlinks() returns, so a page
+    # never links to itself. Pages are numbered in items table order.
+    @classmethod
+    def from_cache(cls, cache):
+        with cache.reader() as connection:
+            uuids = []
+            names = []
+            node = {}
+            for id, uuid, displayname in connection.execute('SELECT id, uuid, displayname FROM items ORDER BY id'):
+                node[id] = len(uuids)
+                uuids.append(uuid)
+                names.append(displayname)
+
+            offsets = array('q', [0]) * (len(uuids) + 1)
+            targets = array('i')
+
+            rows = connection.execute('''SELECT s.id,
+                                                (SELECT t.id FROM items t WHERE t.key = r.key AND t.uuid != r.uuid
+                                                 ORDER BY t.uuid LIMIT 1)
+                                         FROM (SELECT DISTINCT uuid, key FROM refs) r JOIN items s ON s.uuid = r.uuid
+                                         ORDER BY s.id''')
+
+            # Rows arrive grouped by source, so the targets of each page can be
+            # sorted and appended as soon as the next page starts.
+            for source, group in itertools.groupby(rows, key=lambda row: row[0]):
+                v = node[source]
+                links = sorted(set(node[target] for _, target in group if target is not None))
+                targets.extend(links)
+                offsets[v + 1] = len(links)
+
+        for v in range(len(uuids)):
+            offsets[v + 1] += offsets[v]
+
+        return cls(uuids, names, offsets, targets)
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def edge_count(self):
+        return len(self.targets)
+
+    # Returns the number of bytes used by the adjacency arrays.
+    def nbytes(self):
+        size = len(self.offsets) * self.offsets.itemsize + len(self.targets) * self.targets.itemsize
+        if self.reverse_ is not None:
+            offsets, sources = self.reverse_
+            size += len(offsets) * offsets.itemsize + len(sources) * sources.itemsize
+        return size
+
+    def links(self, v):
+        return self.targets[self.offsets[v]:self.offsets[v + 1]]
+
+    def backlinks(self, v):
+        offsets, sources = self.reverse()
+        return sources[offsets[v]:offsets[v + 1]]
+
+    def out_degrees(self):
+        offsets = self.offsets
+        return array('i', map(int.__sub__, offsets[1:], offsets[:-1]))
+
+    def in_degrees(self):
+        degrees = array('i', [0]) * len(self.uuids)
+        for t in self.targets:
+            degrees[t] += 1
+        return degrees
+
+    # Returns the (offsets, sources) CSR arrays of the reverse graph. The
+    # sources of each page are sorted.
+    def reverse(self):
+        if self.reverse_ is None:
+            n = len(self.uuids)
+            offsets = array('q', [0]) * (n + 1)
+            offsets[1:] = array('q', itertools.accumulate(self.in_degrees()))
+
+            # A counting sort: each link is placed at the next free slot of
+            # its target. Pages are visited in order, so the sources of each
+            # target come out sorted.
+            next_slot = offsets[:-1]
+            sources = array('i', [0]) * len(self.targets)
+            forward_offsets = self.offsets
+            targets = self.targets
+            for v in range(n):
+                for t in targets[forward_offsets[v]:forward_offsets[v + 1]]:
+                    sources[next_slot[t]] = v
+                    next_slot[t] += 1
+
+            self.reverse_ = (offsets, sources)
+
+        return self.reverse_
+
+    # Returns the pages no other page links to.
+    def orphans(self):
+        return [v for v, degree in enumerate(self.in_degrees()) if degree == 0]
+
+    # Returns the pages that do not link to any other page.
+    def dead_ends(self):
+        return [v for v, degree in enumerate(self.out_degrees()) if degree == 0]
+
+    # Returns the PageRank of every page as an array of floats that sums to
+    # 1. The rank of pages without links is spread over every page.
+    def pagerank(self, damping=0.85, tolerance=1e-6, max_iterations=100):
+        n = len(self.uuids)
+        if n == 0:
+            return array('d')
+
+        offsets, sources = self.reverse()
+        out_degrees = self.out_degrees()
+        dangling = [v for v in range(n) if out_degrees[v] == 0]
+        scale = [1.0 / degree if degree else 0.0 for degree in out_degrees]
+
+        rank = array('d', [1.0 / n]) * n
+        for _ in range(max_iterations):
+            # Each page passes its rank to its links in equal shares. Pull the
+            # shares over the backlinks so every page is written once.
+            share = list(map(float.__mul__, rank, scale))
+            base = (1.0 - damping) / n + damping * sum(rank[v] for v in dangling) / n
+            pull = share.__getitem__
+            new_rank = array('d', (base + damping * sum(map(pull, sources[offsets[v]:offsets[v + 1]])) for v in range(n)))
+
+            delta = sum(map(abs, map(float.__sub__, new_rank, rank)))
+            rank = new_rank
+            if delta < tolerance:
+                break
+
+        return rank
+
+    # Returns the strongly connected components of the graph as lists of
+    # pages, using an iterative version of Tarjan's algorithm. Components are
+    # listed in reverse topological order.
+    def strongly_connected_components(self):  # noqa: C901
+        n = len(self.uuids)
+        offsets = self.offsets
+        targets = self.targets
+
+        index = array('i', [-1]) * n
+        lowlink = array('i', [0]) * n
+        on_stack = bytearray(n)
+        stack = []
+        components = []
+        counter = 0
+
+        for root in range(n):
+            if index[root] != -1:
+                continue
+
+            # Each frame is a page and the position of the next link to visit.
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            frames = [(root, offsets[root])]
+
+            while frames:
+                v, i = frames[-1]
+                end = offsets[v + 1]
+
+                while i < end:
+                    w = targets[i]
+                    i += 1
+                    if index[w] == -1:
+                        break
+                    if on_stack[w] and index[w] < lowlink[v]:
+                        lowlink[v] = index[w]
+                else:
+                    w = -1
+
+                if w != -1:
+                    frames[-1] = (v, i)
+                    index[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = 1
+                    frames.append((w, offsets[w]))
+                    continue
+
+                frames.pop()
+                if frames:
+                    parent = frames[-1][0]
+                    if lowlink[v] < lowlink[parent]:
+                        lowlink[parent] = lowlink[v]
+
+                if lowlink[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = 0
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+
+        return components
+
+    # Returns the shortest chain of links from page source to page target as
+    # a list of pages, both included, or None if target cannot be reached.
+    def shortest_path(self, source, target):
+        offsets = self.offsets
+        targets = self.targets
+
+        parent = array('i', [-1]) * len(self.uuids)
+        parent[source] = source
+        frontier = [source]
+
+        while frontier and parent[target] == -1:
+            next_frontier = []
+            for v in frontier:
+                for w in targets[offsets[v]:offsets[v + 1]]:
+                    if parent[w] == -1:
+                        parent[w] = v
+                        next_frontier.append(w)
+            frontier = next_frontier
+
+        if parent[target] == -1:
+            return None
+
+        path = [target]
+        while path[-1] != source:
+            path.append(parent[path[-1]])
+        path.reverse()
+
+        return path
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+from array import array
+import os
+import tempfile
+import unittest
+
+from datastore import DataStore
+from graph import LinkGraph
+from voodoopad import PageFormat, VPCache
+
+
+# Build a LinkGraph over pages named after their numbers from a list of
+# (source, target) links.
+def make_graph(n, links):
+    offsets = array('q', [0]) * (n + 1)
+    targets = array('i')
+    for v in range(n):
+        targets.extend(sorted(t for s, t in links if s == v))
+        offsets[v + 1] = len(targets)
+
+    return LinkGraph([str(v) for v in range(n)], [str(v) for v in range(n)], offsets, targets)
+
+
+class LinkGraphTest(unittest.TestCase):
+    def test_degrees(self):
+        graph = make_graph(4, [(0, 1), (0, 2), (1, 2), (2, 0)])
+
+        self.assertEqual(list(graph.out_degrees()), [2, 1, 1, 0])
+        self.assertEqual(list(graph.in_degrees()), [1, 1, 2, 0])
+        self.assertEqual(list(graph.backlinks(2)), [0, 1])
+        self.assertEqual(graph.orphans(), [3])
+        self.assertEqual(graph.dead_ends(), [3])
+
+    def test_pagerank(self):
+        # A cycle ranks every page the same.
+        rank = make_graph(3, [(0, 1), (1, 2), (2, 0)]).pagerank()
+        for r in rank:
+            self.assertAlmostEqual(r, 1 / 3)
+
+        # A page every other page links to ranks highest.
+        rank = make_graph(4, [(1, 0), (2, 0), (3, 0), (0, 1)]).pagerank()
+        self.assertAlmostEqual(sum(rank), 1.0)
+        self.assertEqual(max(range(4), key=lambda v: rank[v]), 0)
+        self.assertAlmostEqual(rank[2], rank[3])
+
+    def test_components(self):
+        graph = make_graph(6, [(0, 1), (1, 2), (2, 0), (2, 3), (3, 4), (4, 3), (5, 0)])
+
+        components = sorted(sorted(c) for c in graph.strongly_connected_components())
+        self.assertEqual(components, [[0, 1, 2], [3, 4], [5]])
+
+        # Components come in reverse topological order.
+        order = [min(c) for c in graph.strongly_connected_components()]
+        self.assertEqual(order, [3, 0, 5])
+
+    def test_shortest_path(self):
+        graph = make_graph(5, [(0, 1), (1, 2), (2, 3), (0, 2), (3, 0)])
+
+        self.assertEqual(graph.shortest_path(0, 3), [0, 2, 3])
+        self.assertEqual(graph.shortest_path(3, 3), [3])
+        self.assertEqual(graph.shortest_path(0, 4), None)
+
+    def test_from_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'Test.vpdoc')
+            ds = DataStore.create(path)
+            apple = ds.add_item('Apple', 'Makes computers like the commodore amiga', PageFormat.MarkDown)
+            atari = ds.add_item('Atari', 'Atari competed with apple', PageFormat.MarkDown)
+            falcon = ds.add_item('Atari Falcon', 'The Atari Falcon was made by atari', PageFormat.MarkDown)
+
+            cache = VPCache(path, in_memory=True)
+            cache.update_cache(ds)
+            graph = LinkGraph.from_cache(cache)
+
+            self.assertEqual(len(graph), len(ds.item_uuids()))
+            for uuid in [apple, atari, falcon]:
+                v = graph.ids[uuid]
+                self.assertEqual([graph.uuids[w] for w in graph.links(v)], cache.get_forwardlinks(uuid))
+                # Links from a page to itself are left out of the graph.
+                backlinks = [u for u in cache.get_backlinks(uuid) if u != uuid]
+                self.assertEqual(sorted(graph.uuids[w] for w in graph.backlinks(v)), sorted(backlinks))
+
+            self.assertEqual(graph.shortest_path(graph.ids[falcon], graph.ids[apple]),
+                             [graph.ids[falcon], graph.ids[atari], graph.ids[apple]])
+            cache.close()
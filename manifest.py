@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from pathlib import Path
+import sqlite3
+
+from utility import is_unreadable_database, remove_database
+
+
+# Bump this whenever the layout of the manifest changes. Manifests with a
+# different version are discarded and rebuilt from the item plists.
+MANIFEST_VERSION = 3
+
+
+# The manifest remembers the fields DataStore keeps in memory for every item
+# plist in a document (see datastore.ITEM_FIELDS), keyed by the plist's path
+# relative to pages/ and by the (mtime_ns, size, inode) stat signature of the
+# file when it was parsed. A plist only needs to be parsed again if its
+# signature has changed.
+class Manifest:
+    def __init__(self, ds_path):
+        self.db_path = str(Path(ds_path, 'manifest.db'))
+        self.conn_ = None
+
+        try:
+            self.init_manifest()
+        except sqlite3.DatabaseError as error:
+            # The manifest is only a cache. Throw away a file we cannot read,
+            # but not one that is merely locked or otherwise busy.
+            if not is_unreadable_database(error):
+                raise
+            self.close()
+            remove_database(self.db_path)
+            self.init_manifest()
+
+    def get_connection(self):
+        if self.conn_ is None:
+            self.conn_ = sqlite3.connect(self.db_path)
+
+        return self.conn_
+
+    def init_manifest(self):
+        connection = self.get_connection()
+        cursor = connection.cursor()
+
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version == MANIFEST_VERSION:
+            return
+
+        cursor.execute('DROP TABLE IF EXISTS plists')
+        cursor.execute('DROP TABLE IF EXISTS meta')
+        cursor.execute('''CREATE TABLE plists(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, inode INTEGER,
+                                              uuid TEXT, key TEXT, displayName TEXT, uti TEXT, dataHash TEXT)''')
+        cursor.execute('''CREATE TABLE meta(name TEXT PRIMARY KEY, value)''')
+        cursor.execute(f'PRAGMA user_version = {MANIFEST_VERSION}')
+
+        connection.commit()
+
+    def close(self):
+        if self.conn_ is not None:
+            self.conn_.close()
+            self.conn_ = None
+
+    def get_value(self, name, default=None):
+        cursor = self.get_connection().cursor()
+        row = cursor.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_value(self, name, value):
+        connection = self.get_connection()
+        connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+        connection.commit()
+
+    # Returns a dict mapping each path to a (signature, fields) tuple.
+    def entries(self):
+        cursor = self.get_connection().cursor()
+
+        entries = {}
+        for row in cursor.execute('SELECT * FROM plists'):
+            entries[row[0]] = (row[1:4], row[4:])
+
+        return entries
+
+    # Store the changed plists (a list of (path, signature, fields) tuples) and
+    # forget the deleted paths in a single transaction.
+    def update(self, changed, deleted):
+        if not changed and not deleted:
+            return
+
+        connection = self.get_connection()
+        cursor = connection.cursor()
+
+        rows = [(path, *signature, *fields) for path, signature, fields in changed]
+
+        cursor.executemany('INSERT OR REPLACE INTO plists VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        cursor.executemany('DELETE FROM plists WHERE path = ?', [(path,) for path in deleted])
+
+        connection.commit()
+
+
+# Returns the stat signature the manifest uses to detect changed plists.
+def stat_signature(entry):
+    st = entry.stat()
+    return (st.st_mtime_ns, st.st_size, entry.inode())
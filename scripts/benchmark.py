@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import datetime
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent)
+
+from array import array  # noqa: E402
+import datastore  # noqa: E402
+from graph import LinkGraph  # noqa: E402
+import tokenizer  # noqa: E402
+import voodoopad  # noqa: E402
+from wordmatcher import WordMatcher  # noqa: E402
+from wordtrie import WordTrie  # noqa: E402
+
+
+WORDS = [
+    'apple', 'atari', 'falcon', 'computer', 'video', 'game', 'crash', 'home',
+    'personal', 'history', 'market', 'software', 'hardware', 'company',
+    'console', 'keyboard', 'monitor', 'printer', 'network', 'memory',
+]
+
+
+def random_title(rng, i):
+    words = rng.sample(WORDS, rng.randint(1, 3))
+    return ' '.join(words).title() + f' {i}'
+
+
+def random_text(rng, titles, size):
+    words = []
+    while len(words) < size:
+        if titles and rng.random() < 0.05:
+            words.append(rng.choice(titles))
+        else:
+            words.append(rng.choice(WORDS))
+    return ' '.join(words)
+
+
+# Create a synthetic document with the given number of pages.
+def generate(args):
+    rng = random.Random(args.seed)
+    ds = datastore.DataStore.create(args.document)
+
+    titles = [random_title(rng, i) for i in range(args.pages)]
+    ds.add_items((title, random_text(rng, titles, args.words), 'net.daringfireball.markdown') for title in titles)
+
+    # Add the fields VoodooPad itself writes to every item plist.
+    if args.full_plists:
+        now = datetime.datetime(2021, 7, 14, 20, 45, 36)
+        for uuid in ds.item_uuids():
+            plist = ds.item_plist(uuid).to_plist()
+            plist.update({
+                'aliases': [],
+                'attributes': {
+                    'documentBackgroundColor': bytes(48),
+                    'lastEditingComputerName': 'benchmark',
+                    'lastEditingUserName': 'benchmark',
+                },
+                'categories': [],
+                'createdDate': now,
+                'encrypted': 'No',
+                'metaValues': {},
+                'modifiedDate': now,
+                'shouldHighlightLinks': 'Yes',
+                'skipOnExport': 'No',
+                'version': 1,
+            })
+            ds.save_plist(plist, ds.item_plist_path(uuid))
+
+
+def time_call(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+# Time DataStore.open with an increasing number of worker processes.
+def bench_open(args):
+    baseline = None
+    for workers in args.workers:
+        def open_document():
+            return datastore.DataStore.open(args.document, in_memory=args.in_memory, eager=args.eager, workers=workers)
+
+        elapsed = time_call(open_document, args.repeat)
+        if baseline is None:
+            baseline = elapsed
+        print(f'workers={workers:<3} {elapsed:8.3f}s  speedup={baseline / elapsed:5.2f}x')
+
+
+# Compare the memory retained by the item records DataStore keeps with the
+# memory the full plist dicts would take.
+def bench_memory(args):
+    ds = datastore.DataStore.open(args.document, in_memory=True)
+    paths = {uuid: ds.item_plist_path(uuid) for uuid in ds.item_uuids()}
+    ds.item_plists = {}
+
+    tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    plists = {uuid: ds.load_plist(path) for uuid, path in paths.items()}
+    full = tracemalloc.get_traced_memory()[0] - before
+    del plists
+
+    before = tracemalloc.get_traced_memory()[0]
+    records = {uuid: datastore.ItemRecord.from_plist(ds, uuid, ds.load_plist(path)) for uuid, path in paths.items()}
+    compact = tracemalloc.get_traced_memory()[0] - before
+
+    tracemalloc.stop()
+
+    count = len(records)
+    print(f'pages:         {count}')
+    print(f'plist dicts:   {full / 1024 / 1024:8.2f} MB  ({full // count} bytes/page)')
+    print(f'item records:  {compact / 1024 / 1024:8.2f} MB  ({compact // count} bytes/page)')
+    print(f'reduction:     {full / compact:8.2f}x')
+
+
+# Compare adding pages one at a time, where every page is flushed to disk on
+# its own, with adding them in a batch that commits its writes as a group.
+def bench_write(args):
+    rng = random.Random(args.seed)
+    titles = [random_title(rng, i) for i in range(args.pages)]
+    texts = [random_text(rng, titles, args.words) for _ in titles]
+
+    for mode in ['single', 'batch']:
+        path = os.path.join(args.directory, f'{mode}.vpdoc')
+        ds = datastore.DataStore.create(path)
+
+        start = time.perf_counter()
+        if mode == 'single':
+            for title, text in zip(titles, texts):
+                ds.add_item(title, text, 'net.daringfireball.markdown')
+        else:
+            ds.add_items((title, text, 'net.daringfireball.markdown') for title, text in zip(titles, texts))
+        elapsed = time.perf_counter() - start
+
+        print(f'{mode:<7} {elapsed:8.3f}s  {args.pages / elapsed:10.0f} pages/s')
+
+
+# Time per-page link queries against the cache, with the cache indexes and
+# then without them.
+def bench_queries(args):
+    ds = datastore.DataStore.open(args.document, in_memory=True)
+    cache = voodoopad.VPCache(args.document, True)
+    cache.update_cache(ds)
+
+    uuids = list(ds.item_uuids())
+    rng = random.Random(args.seed)
+    sample = [rng.choice(uuids) for _ in range(args.queries)]
+
+    def run():
+        for uuid in sample:
+            cache.get_backlinks(uuid)
+            cache.get_forwardlinks(uuid)
+
+    with_indexes = time_call(run, args.repeat)
+
+    connection = cache.get_connection()
+    for index in ['items_key', 'refs_key', 'refs_uuid']:
+        connection.execute(f'DROP INDEX {index}')
+
+    without_indexes = time_call(run, args.repeat)
+
+    print(f'queries:          {args.queries}')
+    print(f'without indexes:  {without_indexes * 1e6 / args.queries:10.1f} us/page')
+    print(f'with indexes:     {with_indexes * 1e6 / args.queries:10.1f} us/page')
+
+
+# Answer backlink queries from several threads at once and report the
+# throughput, the query latency and how long threads waited for a connection.
+# An in-memory cache has no reader pool, so its queries run one at a time and
+# show the cost of the writer lock instead.
+def bench_concurrent(args):
+    ds = datastore.DataStore.open(args.document, in_memory=args.in_memory)
+
+    uuids = list(ds.item_uuids())
+    rng = random.Random(args.seed)
+    sample = [rng.choice(uuids) for _ in range(args.queries)]
+
+    print(f'{"threads":>7} {"queries/s":>10} {"p50":>9} {"p99":>9} {"waits":>6} {"wait":>8}')
+    for threads in args.threads:
+        cache = voodoopad.VPCache(args.document, args.in_memory, readers=args.readers)
+        cache.update_cache(ds)
+
+        latencies = [[] for _ in range(threads)]
+
+        def run(i):
+            for uuid in sample[i::threads]:
+                start = time.perf_counter()
+                cache.get_backlinks(uuid)
+                latencies[i].append(time.perf_counter() - start)
+
+        workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        samples = sorted(latency for thread in latencies for latency in thread)
+        p50 = samples[len(samples) // 2]
+        p99 = samples[min(len(samples) - 1, len(samples) * 99 // 100)]
+        stats = cache.reader_stats()
+        if stats is None:
+            waits, wait_time = '-', '-'
+        else:
+            waits, wait_time = stats['waits'], f'{stats["wait_time"]:.3f}s'
+        print(f'{threads:>7} {len(samples) / elapsed:10.0f} {p50 * 1e6:7.1f}us {p99 * 1e6:7.1f}us '
+              f'{waits:>6} {wait_time:>8}')
+
+        cache.close()
+
+
+# Time the link graph algorithms, on the link graph of a document or on a
+# random graph, and report the size of the graph.
+def bench_graph(args):
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    if args.document:
+        ds = datastore.DataStore.open(args.document, in_memory=True)
+        cache = voodoopad.VPCache(args.document, True)
+        cache.update_cache(ds)
+        start = time.perf_counter()
+        graph = LinkGraph.from_cache(cache)
+    else:
+        rng = random.Random(args.seed)
+        offsets = array('q', [0]) * (args.pages + 1)
+        targets = array('i')
+        for v in range(args.pages):
+            targets.extend(sorted(set(rng.randrange(args.pages) for _ in range(args.links)) - {v}))
+            offsets[v + 1] = len(targets)
+        uuids = [str(v) for v in range(args.pages)]
+        graph = LinkGraph(uuids, uuids, offsets, targets)
+    load = time.perf_counter() - start
+
+    timings = [('load', load)]
+    for name, function in [('reverse', graph.reverse),
+                           ('orphans', graph.orphans),
+                           ('dead ends', graph.dead_ends),
+                           ('pagerank', graph.pagerank),
+                           ('components', graph.strongly_connected_components),
+                           ('path', lambda: graph.shortest_path(0, len(graph) - 1))]:
+        start = time.perf_counter()
+        function()
+        timings.append((name, time.perf_counter() - start))
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'pages:        {len(graph)}')
+    print(f'links:        {graph.edge_count()}')
+    print(f'arrays:       {graph.nbytes() / 2 ** 20:10.1f} MiB')
+    print(f'peak memory:  {peak / 2 ** 20:10.1f} MiB')
+    for name, elapsed in timings:
+        print(f'{name + ":":<13} {elapsed:10.3f}s')
+
+
+# Measure the memory used by a WordTrie of random page names, and time
+# building it and looking names up in it.
+def bench_trie(args):
+    rng = random.Random(args.seed)
+    vocabulary = [f'{rng.choice(WORDS)}{i}' for i in range(args.vocabulary)]
+    titles = [[rng.choice(vocabulary) for _ in range(rng.randint(1, args.title_words))] for _ in range(args.titles)]
+
+    def build_trie():
+        trie = WordTrie()
+        for title in titles:
+            trie.add(title)
+        return trie
+
+    # tracemalloc slows allocation down, so the build is timed separately.
+    tracemalloc.start()
+    trie = build_trie()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    build = time_call(build_trie, 1)
+
+    sample = [rng.choice(titles) for _ in range(args.queries)]
+    lookups = time_call(lambda: [trie.query(title) for title in sample], args.repeat)
+
+    words = [rng.choice(vocabulary) for _ in range(args.queries)]
+    root = trie.root
+    word_lookups = time_call(lambda: [root.query_word(word) for word in words], args.repeat)
+
+    # Saving and loading a snapshot, and hashing the titles to check that a
+    # snapshot is current, as DataStore.title_trie() does.
+    names = [' '.join(title) for title in titles]
+    start = time.perf_counter()
+    tag = hashlib.sha1('\n'.join(sorted(names)).encode('utf-8')).digest()
+    hash_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot = trie.to_snapshot(tag)
+    save = time.perf_counter() - start
+
+    load = time_call(lambda: WordTrie.from_snapshot(snapshot, tag), args.repeat)
+
+    print(f'titles:        {args.titles}')
+    print(f'nodes:         {len(trie)}')
+    print(f'words:         {len(trie.word_list)}')
+    print(f'edges:         {trie.edge_count()}')
+    print(f'memory:        {size / 2 ** 20:10.1f} MiB ({size / args.titles:.0f} bytes/title)')
+    print(f'build:         {build:10.3f}s')
+    print(f'query:         {lookups / args.queries * 1e6:10.3f} us/title')
+    print(f'query_word:    {word_lookups / args.queries * 1e6:10.3f} us/word')
+    print(f'snapshot:      {len(snapshot) / 2 ** 20:10.1f} MiB')
+    print(f'save:          {save:10.3f}s')
+    print(f'hash titles:   {hash_time:10.3f}s')
+    print(f'load:          {load:10.3f}s')
+
+
+# Time finding page names in page text by walking the trie from every word
+# and with the Aho-Corasick matcher, for a random set of page names.
+def bench_matcher(args):
+    rng = random.Random(args.seed)
+    vocabulary = [f'{rng.choice(WORDS)}{i}' for i in range(args.vocabulary)] + WORDS
+
+    trie = WordTrie()
+    for _ in range(args.titles):
+        trie.add([rng.choice(vocabulary) for _ in range(rng.randint(1, args.title_words))])
+
+    # Text made mostly of words that start names, so that many partial
+    # matches are in progress at once.
+    texts = [' '.join(rng.choice(vocabulary) for _ in range(args.words)) for _ in range(args.pages)]
+
+    start = time.perf_counter()
+    matcher = WordMatcher(trie)
+    compile_time = time.perf_counter() - start
+
+    def run(matcher):
+        return [set(tokenizer.VPItem(text, trie, matcher=matcher).item_keywords()) for text in texts]
+
+    walk = time_call(lambda: run(None), args.repeat)
+    automaton = time_call(lambda: run(matcher), args.repeat)
+    assert run(None) == run(matcher)
+
+    print(f'titles:          {args.titles}')
+    print(f'automaton nodes: {len(matcher)}')
+    print(f'compile:         {compile_time:10.3f}s')
+    print(f'trie walk:       {walk / args.pages * 1e3:10.3f} ms/page')
+    print(f'aho-corasick:    {automaton / args.pages * 1e3:10.3f} ms/page')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('generate', help='create a synthetic document')
+    p.add_argument('document', help='document')
+    p.add_argument('--pages', type=int, default=10000, help='number of pages')
+    p.add_argument('--words', type=int, default=200, help='words per page')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.add_argument('--full-plists', action='store_true', help='write every field VoodooPad writes to item plists')
+    p.set_defaults(func=generate)
+
+    p = subparsers.add_parser('open', help='time DataStore.open')
+    p.add_argument('document', help='document')
+    p.add_argument('--eager', action='store_true', help='read page bodies at open time')
+    p.add_argument('--in-memory', action='store_true', help='do not use the plist manifest')
+    p.add_argument('--repeat', type=int, default=3, help='number of runs per configuration')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()], help='worker counts to time')
+    p.set_defaults(func=bench_open)
+
+    p = subparsers.add_parser('memory', help='measure per-page memory of item records')
+    p.add_argument('document', help='document')
+    p.set_defaults(func=bench_memory)
+
+    p = subparsers.add_parser('write', help='time crash-safe page writes')
+    p.add_argument('directory', help='directory to create the documents in')
+    p.add_argument('--pages', type=int, default=1000, help='number of pages')
+    p.add_argument('--words', type=int, default=200, help='words per page')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=bench_write)
+
+    p = subparsers.add_parser('queries', help='time link queries against the cache')
+    p.add_argument('document', help='document')
+    p.add_argument('--queries', type=int, default=1000, help='number of pages to query')
+    p.add_argument('--repeat', type=int, default=3, help='number of runs per configuration')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=bench_queries)
+
+    p = subparsers.add_parser('concurrent', help='time backlink queries from several threads')
+    p.add_argument('document', help='document')
+    p.add_argument('--in-memory', action='store_true', help='use an in-memory cache (queries run one at a time)')
+    p.add_argument('--queries', type=int, default=10000, help='number of pages to query')
+    p.add_argument('--readers', type=int, default=voodoopad.DEFAULT_READERS, help='size of the read connection pool')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='thread counts to time')
+    p.set_defaults(func=bench_concurrent)
+
+    p = subparsers.add_parser('graph', help='time the link graph algorithms')
+    p.add_argument('document', nargs='?', default=None, help='document (a random graph is used if omitted)')
+    p.add_argument('--pages', type=int, default=100000, help='number of pages in the random graph')
+    p.add_argument('--links', type=int, default=20, help='links per page in the random graph')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=bench_graph)
+
+    p = subparsers.add_parser('trie', help='measure the memory and lookup time of the page name trie')
+    p.add_argument('--titles', type=int, default=1000000, help='number of page names')
+    p.add_argument('--title-words', type=int, default=6, help='maximum words per page name')
+    p.add_argument('--vocabulary', type=int, default=50000, help='number of distinct words')
+    p.add_argument('--queries', type=int, default=100000, help='number of lookups')
+    p.add_argument('--repeat', type=int, default=3, help='number of runs per configuration')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=bench_trie)
+
+    p = subparsers.add_parser('matcher', help='compare the trie walk with the Aho-Corasick matcher')
+    p.add_argument('--titles', type=int, default=100000, help='number of page names')
+    p.add_argument('--title-words', type=int, default=6, help='maximum words per page name')
+    p.add_argument('--vocabulary', type=int, default=2000, help='number of distinct words')
+    p.add_argument('--pages', type=int, default=200, help='number of pages to scan')
+    p.add_argument('--words', type=int, default=1000, help='words per page')
+    p.add_argument('--repeat', type=int, default=3, help='number of runs per configuration')
+    p.add_argument('--seed', type=int, default=0, help='random seed')
+    p.set_defaults(func=bench_matcher)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -46,12 +46,12 @@ def main():
 
     vp = voodoopad.VoodooPad(args.document)
 
-    for file in glob.glob(f'{args.directory}/*.json'):
-        with open(file, 'r') as f:
-            article = json.loads(f.read())
-            vp.add(article['markdown'], article['title'], 'markdown')
-
-    vp.cache_.update_cache(vp.ds_)
+    with vp.batch() as batch:
+        for file in glob.glob(f'{args.directory}/*.json'):
+            with open(file, 'r') as f:
+                article = json.loads(f.read())
+                if batch.add(article['title'], article['markdown'], voodoopad.PageFormat.MarkDown) is None:
+                    print(f"Skipping {article['title']}: a page with that name already exists")
 
 
 if __name__ == '__main__':
@@ -20,8 +20,11 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+from array import array
 import re
 
+from wordtrie import EDGE_SHIFT
+
 
 def is_wikiword(word):
     # Must be alphanumeric
@@ -50,6 +53,23 @@ def tokenize_text(text):
     return re.split(r"[\s\r\n;,.()-]+", text)
 
 
+WORD_PATTERN = re.compile(r"[^\s\r\n;,.()-]+")
+
+# The same separators for ASCII bytes. \s in a str pattern also matches the
+# ASCII separators \x1c-\x1f, which \s in a bytes pattern does not.
+WORD_BYTES_PATTERN = re.compile(rb"[^\s\x1c-\x1f\r\n;,.()-]+")
+NON_ASCII_BYTES_PATTERN = re.compile(rb"[\x80-\xff]")
+
+
+# Returns text, decoded if it is a bytes-like object holding UTF-8 that is not
+# pure ASCII. Non-ASCII whitespace such as a no-break space separates words
+# too, and only the str pattern knows about it.
+def decode_non_ascii(text):
+    if not isinstance(text, str) and NON_ASCII_BYTES_PATTERN.search(text):
+        return str(text, 'utf-8')
+    return text
+
+
 def lookup_name(words, start, trie):
     best = None
 
@@ -70,33 +90,157 @@ def lookup_name(words, start, trie):
     return words[start:(best + 1)]
 
 
+# The words of a text as parallel arrays: word i is text[starts[i]:ends[i]]
+# and its lower case form is vocabulary[ids[i]]. Each distinct lower case
+# word is stored once, so a long page costs about 20 bytes per word. text may
+# be a str or a bytes-like object holding UTF-8. ASCII bytes are kept as they
+# are and the offsets are byte offsets; other bytes are decoded (see
+# decode_non_ascii()), so offsets always index self.text.
+class TokenStream:
+    def __init__(self, text):
+        text = decode_non_ascii(text)
+        self.text = text
+
+        is_str = isinstance(text, str)
+        pattern = WORD_PATTERN if is_str else WORD_BYTES_PATTERN
+
+        self.starts = starts = array('q')
+        self.ends = ends = array('q')
+        self.ids = ids = array('i')
+        self.vocabulary = vocabulary = []
+
+        # The indexes of the words with upper case letters, the only ones that
+        # can be WikiWords.
+        self.cased = cased = array('i')
+
+        # Words are packed into the arrays as they are matched, so no list of
+        # matches or words as long as the page is ever held. Vocabulary ids
+        # are assigned in order of first occurrence.
+        index = {}
+        for i, match in enumerate(pattern.finditer(text)):
+            word = match.group()
+            if not is_str:
+                word = word.decode('utf-8')
+            folded = word.lower()
+
+            id = index.get(folded)
+            if id is None:
+                id = index[folded] = len(vocabulary)
+                vocabulary.append(folded)
+
+            start, end = match.span()
+            starts.append(start)
+            ends.append(end)
+            ids.append(id)
+            if folded != word:
+                cased.append(i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Returns word i as it appears in the text.
+    def word(self, i):
+        word = self.text[self.starts[i]:self.ends[i]]
+        if not isinstance(word, str):
+            word = bytes(word).decode('utf-8')
+        return word
+
+    # Returns the lower case form of word i.
+    def folded(self, i):
+        return self.vocabulary[self.ids[i]]
+
+    # Returns the lower case forms of every word, in order.
+    def folded_words(self):
+        return list(map(self.vocabulary.__getitem__, self.ids))
+
+
 class VPItem:
-    def __init__(self, text, trie):
-        self.tokens = []
+    # text may be a str, a bytes-like object holding UTF-8 or a TokenStream.
+    # The text is tokenized once, and both WikiWords and page names are found
+    # in the same token stream. If collect_words is True the set of distinct
+    # lower case words is kept in self.words.
+    #
+    # Names are found by walking the trie from every word, or by matcher (a
+    # wordmatcher.WordMatcher compiled from the same trie) if one is given.
+    # Either way the longest name starting at each word is kept. self.spans
+    # maps the index of the first word of each keyword found to the index
+    # just past its last word.
+    def __init__(self, text, trie, collect_words=False, matcher=None):
+        self.stream = text if isinstance(text, TokenStream) else TokenStream(text)
+        self.words = set(self.stream.vocabulary) if collect_words else None
+        self.spans = {}
 
-        words = tokenize_text(text)
+        stream = self.stream
+        words = stream.folded_words()
 
-        self.find_wikiwords(words)
+        if matcher is not None:
+            for _, start, end in matcher.find(words):
+                # Names ending later were found later, so the last name seen
+                # for a start is the longest.
+                self.spans[start] = end
+        else:
+            self.find_names(trie)
+
+        keywords = set(' '.join(words[start:end]) for start, end in self.spans.items())
+
+        for i in stream.cased:
+            word = stream.word(i)
+            if is_wikiword(word):
+                keywords.add(word)
+                self.spans.setdefault(i, i + 1)
 
-        words = tokenize_text(text.lower())
+        self.tokens = list(keywords)
 
-        for i in range(len(words)):
-            # Check to see if the current word is at the root of the trie.
-            branch = trie.query_word(words[i])
-            if branch is None:
+    # Walk the trie from every word, adding the longest name starting at each
+    # word to self.spans. The walk works on trie node numbers and word ids
+    # rather than branch objects.
+    def find_names(self, trie):  # noqa: C901
+        edge = trie.edge
+        word_counts = trie.word_counts
+        shift = EDGE_SHIFT
+
+        # The trie word id of each word in the page, or None for words that
+        # are not in any name.
+        vocabulary_ids = list(map(trie.word_ids.get, self.stream.vocabulary))
+        word_ids = map(vocabulary_ids.__getitem__, self.stream.ids)
+
+        # Partial matches against the trie, as [start, node, end] lists, where
+        # end is the end of the longest name matched so far (or 0).
+        active = []
+
+        for i, word_id in enumerate(word_ids):
+            if word_id is None:
+                # No name continues through this word.
+                for match in active:
+                    if match[2]:
+                        self.spans[match[0]] = match[2]
+                active = []
                 continue
-            else:
-                match = lookup_name(words, i, trie)
-                if match:
-                    self.tokens.append(' '.join(match))
 
-        # Remove duplicates
-        self.tokens = list(set(self.tokens))
+            still_active = []
+            for match in active:
+                node = edge((match[1] << shift) | word_id)
+                if node is None:
+                    # Keep the longest name starting at this position.
+                    if match[2]:
+                        self.spans[match[0]] = match[2]
+                    continue
+                match[1] = node
+                if word_counts[node] > 0:
+                    match[2] = i + 1
+                still_active.append(match)
 
-    def find_wikiwords(self, words):
-        for word in words:
-            if is_wikiword(word):
-                self.tokens.append(word)
+            # Check to see if the current word is at the root of the trie. The
+            # root is node 0, so its edge keys are the word ids themselves.
+            node = edge(word_id)
+            if node is not None:
+                still_active.append([i, node, i + 1 if word_counts[node] > 0 else 0])
+
+            active = still_active
+
+        for match in active:
+            if match[2]:
+                self.spans[match[0]] = match[2]
 
     def item_keywords(self):
         return self.tokens
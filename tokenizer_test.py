@@ -20,10 +20,12 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import tracemalloc
 import unittest
 
+from wordmatcher import WordMatcher
 from wordtrie import WordTrie
-from tokenizer import tokenize_text, VPItem
+from tokenizer import tokenize_text, TokenStream, VPItem
 
 
 class TokenizerTest(unittest.TestCase):
@@ -35,6 +37,10 @@ class TokenizerTest(unittest.TestCase):
 
         self.assertTrue(keywords == expected)
 
+        # The Aho-Corasick matcher finds the same names as the trie walk.
+        item = VPItem(text, trie, matcher=WordMatcher(trie))
+        self.assertEqual(set(item.item_keywords()), expected)
+
     def test_smoke(self):
         names = [
             'atari',
@@ -60,3 +66,66 @@ class TokenizerTest(unittest.TestCase):
         text = 'atari made the atari falcon and the atari st computers'
         expected = ['atari', 'atari falcon', 'atari st']
         self.links(trie, text, expected)
+
+        # UTF-8 bytes-like text gives the same keywords as str text.
+        text = 'the Atari Falcon and the VideoGame crash of 1983'
+        expected = ['atari falcon', 'VideoGame']
+        self.links(trie, text, expected)
+        self.links(trie, memoryview(text.encode('utf-8')), expected)
+
+    def test_token_stream(self):
+        text = 'Atari, the ATARI Falcon (1992)'
+        for source in [text, memoryview(text.encode('utf-8'))]:
+            stream = TokenStream(source)
+            self.assertEqual(len(stream), 5)
+            self.assertEqual([stream.word(i) for i in range(5)], ['Atari', 'the', 'ATARI', 'Falcon', '1992'])
+            self.assertEqual(stream.folded_words(), ['atari', 'the', 'atari', 'falcon', '1992'])
+            self.assertEqual(len(stream.vocabulary), 4)
+            self.assertEqual((stream.starts[3], stream.ends[3]), (17, 23))
+
+        # Offsets into ASCII bytes count bytes. Other UTF-8 text is decoded
+        # first, so offsets index stream.text either way.
+        stream = TokenStream(b'the Atari')
+        self.assertEqual(stream.word(1), 'Atari')
+        self.assertEqual(stream.starts[1], 4)
+
+        stream = TokenStream('café Atari'.encode('utf-8'))
+        self.assertEqual(stream.word(1), 'Atari')
+        self.assertEqual(stream.text[stream.starts[1]:stream.ends[1]], 'Atari')
+
+        trie = WordTrie()
+        trie.add(['atari', 'falcon'])
+        item = VPItem(TokenStream(text), trie)
+        self.assertEqual(item.spans, {2: 4})
+
+    def test_token_stream_memory(self):
+        # A large page costs its token arrays and vocabulary, about 20 bytes
+        # per word, and no per-word Python objects while it is tokenized.
+        text = ' '.join(f'Word{i % 500} word{i % 700}' for i in range(25000)).encode('utf-8')
+
+        tracemalloc.start()
+        try:
+            stream = TokenStream(memoryview(text))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(len(stream), 50000)
+        self.assertLess(peak, 32 * len(stream))
+
+    def test_non_ascii_whitespace(self):
+        # A no-break space separates words in bytes as it does in str text.
+        text = 'the Atari\u00a0Falcon and\u2003VideoGame\x1fcrash'
+        words = ['the', 'Atari', 'Falcon', 'and', 'VideoGame', 'crash']
+        for source in (text, memoryview(text.encode('utf-8'))):
+            stream = TokenStream(source)
+            self.assertEqual([stream.word(i) for i in range(len(stream))], words)
+        stream = TokenStream(b'Atari\x1fFalcon')
+        self.assertEqual([stream.word(i) for i in range(len(stream))], ['Atari', 'Falcon'])
+
+        stream = TokenStream(memoryview(text.encode('utf-8')))
+        self.assertEqual(stream.folded_words(), [word.lower() for word in words])
+
+        trie = WordTrie()
+        trie.add(['atari', 'falcon'])
+        self.links(trie, memoryview(text.encode('utf-8')), ['atari falcon', 'VideoGame'])
@@ -20,7 +20,9 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import os
 import re
+import sqlite3
 import unicodedata
 
 
@@ -36,3 +38,32 @@ def slugify(value):
     value = unicodedata.normalize('NFKC', value)
     value = re.sub(r'[^\w\s-]', '', value.lower())
     return re.sub(r'[-\s]+', '-', value).strip('-_')
+
+
+# SQLite result codes for files that cannot be read as a database at all.
+SQLITE_CORRUPT = 11
+SQLITE_NOTADB = 26
+
+
+# Returns True if error means the database file itself is damaged or is not a
+# database, as opposed to a transient failure such as a locked database or a
+# full disk that throwing the file away would not fix.
+def is_unreadable_database(error):
+    if isinstance(error, sqlite3.OperationalError):
+        return False
+
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (SQLITE_CORRUPT, SQLITE_NOTADB)
+
+    message = str(error)
+    return 'file is not a database' in message or 'disk image is malformed' in message
+
+
+# Deletes the SQLite database at path along with its rollback journal and WAL
+# files. Leaving those behind would let SQLite replay pages from the old
+# database into the new one created at the same path.
+def remove_database(path):
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.isfile(path + suffix):
+            os.remove(path + suffix)
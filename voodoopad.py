@@ -23,14 +23,21 @@
 # flake8: noqa
 
 import argparse
+import contextlib
 import hashlib
+import json
 import os
 from pathlib import Path
+import queue
 import sqlite3
+import sys
+import threading
+import time
 import tokenizer
 
 import datastore
-from utility import slugify
+from graph import LinkGraph
+from utility import is_unreadable_database, remove_database, slugify
 
 
 class PageFormat:
@@ -38,135 +45,595 @@ class PageFormat:
     MarkDown = 'net.daringfireball.markdown'
 
 
+# Returns the UTI for a format name accepted on the command line, or None if
+# the name is not recognised.
+def page_format(format):
+    if format == 'plaintext':
+        return PageFormat.Plaintext
+    elif format == 'markdown':
+        return PageFormat.MarkDown
+    return None
+
+
+# The version of the cache schema, stored in PRAGMA user_version. Bump it and
+# append a migration to CACHE_MIGRATIONS whenever the schema changes.
+CACHE_SCHEMA_VERSION = 4
+
+
+# Raised for a cache written by a newer version of this code.
+class CacheVersionError(sqlite3.DatabaseError):
+    pass
+
+
+# Version 0 is an empty database or a cache written before the schema was
+# versioned. The old tables had no keys or indexes and could hold stale rows,
+# so they are dropped and rebuilt from the document.
+def migrate_cache_v1(cursor):
+    cursor.execute('DROP TABLE IF EXISTS items')
+    cursor.execute('DROP TABLE IF EXISTS refs')
+
+    cursor.execute('''CREATE TABLE items(uuid TEXT PRIMARY KEY, key TEXT, displayname TEXT, dataHash TEXT)''')
+    cursor.execute('''CREATE TABLE refs(wikiword TEXT, uuid TEXT, key TEXT)''')
+
+    cursor.execute('CREATE INDEX items_key ON items(key)')
+    cursor.execute('CREATE INDEX refs_key ON refs(key)')
+    cursor.execute('CREATE INDEX refs_uuid ON refs(uuid)')
+
+
+# Version 2 adds the tokens table, a postings list of the normalized words in
+# every page. Clearing items makes the next update_cache() re-scan every page
+# and fill it in.
+def migrate_cache_v2(cursor):
+    cursor.execute('''CREATE TABLE tokens(token TEXT, uuid TEXT, PRIMARY KEY(token, uuid)) WITHOUT ROWID''')
+    cursor.execute('CREATE INDEX tokens_uuid ON tokens(uuid)')
+
+    cursor.execute('DELETE FROM items')
+    cursor.execute('DELETE FROM refs')
+
+
+# Version 3 adds pages_fts, an FTS5 index of page titles and bodies. The FTS
+# rowid is the page's id in items, which becomes an explicit INTEGER PRIMARY
+# KEY so it is stable. items is recreated empty, so the next update_cache()
+# re-scans every page and fills in the index. If SQLite was built without
+# FTS5 the table is left out and search() is unavailable.
+def migrate_cache_v3(cursor):
+    cursor.execute('DROP TABLE items')
+    cursor.execute('''CREATE TABLE items(id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE, key TEXT, displayname TEXT, dataHash TEXT)''')
+    cursor.execute('CREATE INDEX items_key ON items(key)')
+
+    cursor.execute('DELETE FROM refs')
+    cursor.execute('DELETE FROM tokens')
+
+    try:
+        cursor.execute('''CREATE VIRTUAL TABLE pages_fts USING fts5(title, body)''')
+    except sqlite3.OperationalError:
+        pass
+
+
+# Version 4 adds rendered, the markdown produced by VoodooPad.render_page()
+# for each page, along with the hashes of the inputs it was rendered from.
+def migrate_cache_v4(cursor):
+    cursor.execute('''CREATE TABLE rendered(uuid TEXT PRIMARY KEY, dataHash TEXT, linkHash TEXT, markdown TEXT)''')
+
+
+# CACHE_MIGRATIONS[i] upgrades a cache from version i to version i + 1.
+CACHE_MIGRATIONS = [
+    migrate_cache_v1,
+    migrate_cache_v2,
+    migrate_cache_v3,
+    migrate_cache_v4,
+]
+
+
+# The version of the markdown renderer. It is part of every link hash, so
+# bump it whenever a change to render_page() changes its output to discard
+# the rendered pages in the cache.
+RENDER_VERSION = 2
+
+
+# The number of rendered pages render_document() holds in memory before it
+# stores them in the cache.
+RENDER_CHUNK_SIZE = 256
+
+
+# Returns a hash of everything other than the page text that the rendered
+# markdown of a page depends on: the page's own key, the keywords it links to
+# (see VPCache.get_links()) and the page each keyword resolves to in ds, by
+# UUID and by the file name render_page() links to.
+def link_hash(ds, page_key, links):
+    parts = [str(RENDER_VERSION), page_key]
+    for key in sorted(links):
+        parts.append(key)
+        parts.append(links[key])
+
+        target = ds.find_by_key(key)
+        if target is None:
+            parts.extend(['', ''])
+        else:
+            parts.append(target)
+            parts.append(slugify(ds.item_plist(target)['displayName']))
+
+    return datastore.sha1_hash('\0'.join(parts))
+
+
+# PRAGMAs applied to every connection to an on-disk cache. WAL lets readers
+# proceed while the cache is being refreshed, and with WAL synchronous=NORMAL
+# is still safe against corruption.
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+
+# PRAGMAs applied while update_cache() writes a batch of changes. The cache
+# can always be rebuilt from the document, so durability is traded for speed.
+BULK_PRAGMAS = {
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    'cache_size': -64 * 1024,
+}
+
+
+# The default maximum number of read connections a VPCache keeps open.
+DEFAULT_READERS = 4
+
+
+# A bounded pool of read-only connections. A thread takes a connection for the
+# duration of a query and returns it afterwards, so up to size queries can run
+# at once; further threads wait for a connection to be returned. The counters
+# show how often threads had to wait and for how long, and how long the
+# connections were in use. Once the pool is closed, connections still in use
+# are closed as they are returned and no more are handed out.
+class ReaderPool:
+    def __init__(self, connect, size=DEFAULT_READERS):
+        self.connect_ = connect
+        self.size = size
+        self.lock_ = threading.Lock()
+        self.idle_ = queue.LifoQueue()
+        self.connections_ = []
+        self.closed = False
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.busy_time = 0.0
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        start = time.perf_counter()
+        try:
+            yield connection
+        finally:
+            elapsed = time.perf_counter() - start
+            self.release(connection, elapsed)
+
+    def acquire(self):
+        try:
+            connection = self.idle_.get_nowait()
+        except queue.Empty:
+            connection = None
+            with self.lock_:
+                if not self.closed and len(self.connections_) < self.size:
+                    connection = self.connect_()
+                    self.connections_.append(connection)
+
+            if connection is None and not self.closed:
+                start = time.perf_counter()
+                connection = self.idle_.get()
+                elapsed = time.perf_counter() - start
+                with self.lock_:
+                    self.waits += 1
+                    self.wait_time += elapsed
+
+        # close() wakes waiting threads with None.
+        if connection is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed reader pool')
+
+        with self.lock_:
+            self.acquired += 1
+
+        return connection
+
+    def release(self, connection, elapsed):
+        with self.lock_:
+            self.busy_time += elapsed
+            if not self.closed:
+                self.idle_.put(connection)
+                return
+
+        connection.close()
+
+    # Close the idle connections now and the connections in use when they are
+    # returned. Threads waiting for a connection, and any later callers, get
+    # a ProgrammingError.
+    def close(self):
+        with self.lock_:
+            if self.closed:
+                return
+            self.closed = True
+
+            while True:
+                try:
+                    connection = self.idle_.get_nowait()
+                except queue.Empty:
+                    break
+                if connection is not None:
+                    connection.close()
+            self.connections_ = []
+
+            for _ in range(self.size):
+                self.idle_.put(None)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'connections': len(self.connections_),
+            'acquired': self.acquired,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'busy_time': self.busy_time,
+        }
+
+
+# The link cache. Updates go through a single writer connection, serialized
+# by a lock, while queries use connections from a ReaderPool so that several
+# threads can query the cache at once. On disk, WAL lets the readers run
+# while the writer is updating the cache. An in-memory cache has no reader
+# pool: it is a single private database, so queries use the writer
+# connection and are serialized by the writer lock.
 class VPCache:
-    def __init__(self, ds_path, in_memory=False):
+    def __init__(self, ds_path, in_memory=False, bulk_pragmas=None, pragmas=None, readers=DEFAULT_READERS):
         self.conn_ = None
         self.in_memory_ = in_memory
+        self.bulk_pragmas = dict(BULK_PRAGMAS) if bulk_pragmas is None else bulk_pragmas
+        self.pragmas = dict(CONNECTION_PRAGMAS) if pragmas is None else pragmas
+        self.write_lock_ = threading.RLock()
         if in_memory:
             self.db_path = ':memory:'
+            self.readers_ = None
         else:
             self.db_path = str(Path(ds_path, 'cache.db'))
+            self.readers_ = ReaderPool(self.connect_reader, readers)
 
         self.init_cache()
 
+    def connect(self):
+        # Transactions are managed explicitly (see bulk_transaction()), and
+        # connections may be used by any thread holding them.
+        connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+
+        if not self.in_memory_:
+            for name, value in self.pragmas.items():
+                connection.execute(f'PRAGMA {name} = {value}')
+
+        return connection
+
+    def connect_reader(self):
+        connection = self.connect()
+        connection.execute('PRAGMA query_only = 1')
+        return connection
+
+    # Returns the writer connection. Callers must hold the writer lock.
     def get_connection(self):
         if self.conn_ is None:
-            self.conn_ = sqlite3.connect(self.db_path)
+            self.conn_ = self.connect()
 
         return self.conn_
 
-    def init_cache(self):
-        # If the file exists, assume the tables already exist
-        if not self.in_memory_ and os.path.isfile(self.db_path):
-            return
+    # A context manager that returns a connection for queries.
+    @contextlib.contextmanager
+    def reader(self):
+        if self.readers_ is None:
+            with self.write_lock_:
+                yield self.get_connection()
+        else:
+            with self.readers_.connection() as connection:
+                yield connection
 
+    # Returns the ReaderPool counters, or None for an in-memory cache.
+    def reader_stats(self):
+        if self.readers_ is None:
+            return None
+        return self.readers_.stats()
+
+    # Run the body of the with statement in a single transaction with the
+    # bulk PRAGMAs applied, restoring the previous PRAGMA values afterwards.
+    @contextlib.contextmanager
+    def bulk_transaction(self):
+        with self.write_lock_:
+            with self.write_transaction() as cursor:
+                yield cursor
+
+    # Like bulk_transaction(), for callers already holding the writer lock.
+    @contextlib.contextmanager
+    def write_transaction(self):
         connection = self.get_connection()
-        cursor = connection.cursor()
-
-        # create table
-        cursor.execute('''CREATE TABLE items(uuid TEXT, key TEXT, displayname TEXT, dataHash TEXT)''')
-        cursor.execute('''CREATE TABLE refs(wikiword TEXT, uuid TEXT, key TEXT)''')
 
-        connection.commit()
+        saved = {}
+        for name, value in self.bulk_pragmas.items():
+            saved[name] = connection.execute(f'PRAGMA {name}').fetchone()[0]
+            connection.execute(f'PRAGMA {name} = {value}')
+
+        try:
+            connection.execute('BEGIN')
+            try:
+                yield connection.cursor()
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            for name, value in saved.items():
+                connection.execute(f'PRAGMA {name} = {value}')
 
-    def update_cache(self, ds):
+    def init_cache(self):
+        with self.write_lock_:
+            try:
+                self.migrate_cache()
+            except sqlite3.DatabaseError as error:
+                # Not a cache we understand (a corrupt file, something that is
+                # not a database, or an unknown schema version). The cache can
+                # always be rebuilt, so start over. Anything else, such as a
+                # locked database, is passed on rather than deleting a cache
+                # another process may be using.
+                if not isinstance(error, CacheVersionError) and not is_unreadable_database(error):
+                    raise
+                self.close_writer()
+                if not self.in_memory_:
+                    remove_database(self.db_path)
+                self.migrate_cache()
+
+    # Bring the schema up to CACHE_SCHEMA_VERSION, one migration at a time.
+    def migrate_cache(self):
         connection = self.get_connection()
-        cursor = connection.cursor()
 
-        ds.regenerate_trie()
-        uuids = ds.item_uuids()
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > CACHE_SCHEMA_VERSION:
+            raise CacheVersionError(f'Unsupported cache schema version {version}')
+
+        while version < CACHE_SCHEMA_VERSION:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                CACHE_MIGRATIONS[version](cursor)
+                version += 1
+                cursor.execute(f'PRAGMA user_version = {version}')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def close(self):
+        with self.write_lock_:
+            if self.readers_ is not None:
+                self.readers_.close()
+            self.close_writer()
+
+    def close_writer(self):
+        with self.write_lock_:
+            if self.conn_ is not None:
+                self.conn_.close()
+                self.conn_ = None
+
+    # Bring the cache up to date with the document. Returns the number of
+    # pages that were tokenized.
+    #
+    # Pages whose text changed are re-scanned. Adding, deleting or renaming
+    # a page changes the set of titles other pages can link to, so the pages
+    # that may mention an added or removed title are re-scanned as well. See
+    # pages_mentioning_titles().
+    def update_cache(self, ds):
+        with self.write_lock_:
+            return self.apply_cache_updates(ds)
 
-        updated_items = []
-        new_items = []
+    # The body of update_cache(). Callers must hold the writer lock.
+    def apply_cache_updates(self, ds):  # noqa: C901
+        connection = self.get_connection()
 
-        # Go through the UUIDs and check if any are new or updated
-        for uuid in uuids:
-            item = ds.item_plist(uuid)
-            data_hash = item['dataHash']
+        trie = ds.title_trie()
 
-            cursor.execute('SELECT uuid, dataHash FROM items WHERE uuid = ?', (uuid,))
-            row = cursor.fetchone()
+        # Load the whole items table once and diff it against the document.
+        cached = {}
+        for uuid, key, displayname, data_hash in connection.execute('SELECT uuid, key, displayname, dataHash FROM items'):
+            cached[uuid] = (key, displayname, data_hash)
 
-            # This item does not exist. It is a new item.
+        new_items = []
+        updated_items = []
+        renamed_items = []
+        for uuid in ds.item_uuids():
+            plist = ds.item_plist(uuid)
+            row = cached.get(uuid)
             if row is None:
                 new_items.append(uuid)
                 continue
-
-            # This item was updated
-            if row[1] != data_hash:
+            if row[2] != plist.get('dataHash'):
                 updated_items.append(uuid)
+            if row[0] != plist['key'] or row[1] != plist['displayName']:
+                renamed_items.append(uuid)
 
-        if len(updated_items) == 0 and len(new_items) == 0:
-            return
-
-        # Delete keywords for updated items.
-        for uuid in updated_items:
-            cursor.execute('DELETE FROM refs WHERE uuid = ?', (uuid,))
-
-        for uuid in updated_items:
-            keywords = get_wikiwords(ds, uuid)
-            for k in keywords:
-                cursor.execute('INSERT INTO refs VALUES(?, ?, ?)', (k, uuid, k.lower()))
+        deleted_items = [uuid for uuid in cached if uuid not in ds.item_plists]
 
-        for uuid in new_items:
-            plist = ds.item_plist(uuid)
-            key = plist['key']
-            displayname = plist['displayName']
-            data_hash = plist['dataHash']
-            cursor.execute('INSERT INTO items VALUES (?, ?, ?, ?)', (uuid, key, displayname, data_hash))
-
-            keywords = get_wikiwords(ds, uuid)
-            for k in keywords:
-                cursor.execute('INSERT INTO refs VALUES(?, ?, ?)', (k, uuid, k.lower()))
+        if len(updated_items) == 0 and len(new_items) == 0 and len(deleted_items) == 0 and len(renamed_items) == 0:
+            return 0
 
-        connection.commit()
+        added_titles = [ds.item_plist(uuid)['displayName'] for uuid in new_items + renamed_items]
+        removed_titles = [cached[uuid][1] for uuid in deleted_items + renamed_items]
 
-    def get_backlinks(self, uuid):
-        connection = self.get_connection()
-        cursor = connection.cursor()
+        refresh = set(new_items) | set(updated_items)
+        mentions = self.pages_mentioning_titles(ds, added_titles, removed_titles, refresh)
+        rescan_items = updated_items + sorted(mentions - refresh)
 
-        cursor.execute('SELECT key FROM items WHERE uuid = ?', (uuid,))
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        key = row[0]
+        def item_row(uuid):
+            plist = ds.item_plist(uuid)
+            return (plist['key'], plist['displayName'], plist.get('dataHash'), uuid)
+
+        tokenized = 0
+        has_fts = self.has_fts()
+
+        with self.bulk_transaction() as cursor:
+            cursor.executemany('DELETE FROM refs WHERE uuid = ?', [(uuid,) for uuid in rescan_items + deleted_items])
+            cursor.executemany('DELETE FROM tokens WHERE uuid = ?', [(uuid,) for uuid in updated_items + deleted_items])
+            if has_fts:
+                cursor.executemany('DELETE FROM pages_fts WHERE rowid = (SELECT id FROM items WHERE uuid = ?)',
+                                   [(uuid,) for uuid in updated_items + deleted_items])
+                cursor.executemany('UPDATE pages_fts SET title = ? WHERE rowid = (SELECT id FROM items WHERE uuid = ?)',
+                                   [(ds.item_plist(uuid)['displayName'], uuid) for uuid in renamed_items if uuid not in refresh])
+            cursor.executemany('DELETE FROM items WHERE uuid = ?', [(uuid,) for uuid in deleted_items])
+            cursor.executemany('DELETE FROM rendered WHERE uuid = ?', [(uuid,) for uuid in deleted_items])
+            cursor.executemany('UPDATE items SET key = ?, displayname = ?, dataHash = ? WHERE uuid = ?',
+                               [item_row(uuid) for uuid in sorted(set(updated_items) | set(renamed_items))])
+            cursor.executemany('INSERT INTO items(key, displayname, dataHash, uuid) VALUES (?, ?, ?, ?)',
+                               [item_row(uuid) for uuid in new_items])
+
+            # Stream the bodies of the pages to scan from disk rather than
+            # pulling them all through the item cache. Pages re-scanned only
+            # because of a title change have the same words as before, so
+            # their postings are left alone.
+            for uuid, _, text in ds.iter_items(rescan_items + new_items):
+                tokenized += 1
+                item = tokenizer.VPItem(text, trie, collect_words=uuid in refresh)
+                keywords = item.item_keywords()
+                cursor.executemany('INSERT INTO refs VALUES(?, ?, ?)', [(k, uuid, datastore.normalize_name(k)) for k in keywords])
+                if item.words is not None:
+                    cursor.executemany('INSERT INTO tokens VALUES(?, ?)', [(w, uuid) for w in item.words])
+                if has_fts and uuid in refresh:
+                    cursor.execute('INSERT INTO pages_fts(rowid, title, body) SELECT id, displayname, ? FROM items WHERE uuid = ?',
+                                   (text, uuid))
+
+        return tokenized
+
+    def has_fts(self):
+        with self.reader() as connection:
+            row = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'pages_fts'").fetchone()
+        return row is not None
+
+    # Search the page titles and bodies with an FTS5 query (e.g., 'atari',
+    # 'atari NOT falcon' or '"video game"'). Returns up to limit (uuid,
+    # snippet) tuples, best match first. The snippet shows the matching text
+    # with the matched terms in [brackets].
+    def search(self, query, limit=20):
+        if not self.has_fts():
+            raise sqlite3.NotSupportedError('SQLite was built without FTS5')
+
+        with self.reader() as connection:
+            rows = connection.execute('''SELECT i.uuid, snippet(pages_fts, -1, '[', ']', '...', 16) FROM pages_fts
+                                         JOIN items i ON i.id = pages_fts.rowid
+                                         WHERE pages_fts MATCH ? ORDER BY rank LIMIT ?''', (query, limit))
+            return rows.fetchall()
+
+    # Returns the set of pages whose links may change because the given titles
+    # were added to or removed from the document, leaving out the pages in
+    # exclude. A page that linked to a removed title has a ref with the
+    # title's key. A page can only link to an added title if it contains the
+    # title's first word.
+    def pages_mentioning_titles(self, ds, added_titles, removed_titles, exclude=()):
+        pages = set()
+        with self.reader() as connection:
+            for title in removed_titles:
+                key = ' '.join(datastore.title_words(title))
+                for row in connection.execute('SELECT DISTINCT uuid FROM refs WHERE key = ?', (key,)):
+                    pages.add(row[0])
+
+        first_words = set()
+        for title in added_titles:
+            words = datastore.title_words(title)
+            if words:
+                first_words.add(words[0])
+
+        pages |= self.pages_with_words(first_words)
+
+        return set(uuid for uuid in pages if uuid in ds.item_plists and uuid not in exclude)
+
+    # Returns the set of pages containing any of the given normalized (lower
+    # case) words.
+    def pages_with_words(self, words):
+        pages = set()
+        with self.reader() as connection:
+            for word in words:
+                for row in connection.execute('SELECT uuid FROM tokens WHERE token = ?', (word,)):
+                    pages.add(row[0])
+
+        return pages
+
+    # Returns the set of pages containing every word of the given title. The
+    # words need not be adjacent, so this is a superset of the pages that
+    # mention the title.
+    def find_mentions(self, title):
+        pages = None
+        with self.reader() as connection:
+            for word in set(datastore.title_words(title)):
+                rows = connection.execute('SELECT uuid FROM tokens WHERE token = ?', (word,))
+                found = set(row[0] for row in rows)
+                pages = found if pages is None else pages & found
+                if not pages:
+                    break
 
-        links = []
-        rows = cursor.execute("SELECT uuid FROM refs WHERE key = ?", (key,))
-        for r in rows:
-            links.append(r[0])
+        return pages or set()
 
-        return links
+    # Returns the pages that contain every word of the title of the page with
+    # the given UUID but do not link to it.
+    def unlinked_mentions(self, uuid):
+        with self.reader() as connection:
+            row = connection.execute('SELECT key, displayname FROM items WHERE uuid = ?', (uuid,)).fetchone()
+            if row is None:
+                return None
+            key, displayname = row
 
-    def get_forwardlinks(self, uuid):
-        connection = self.get_connection()
-        cursor = connection.cursor()
+            linked = set(r[0] for r in connection.execute('SELECT uuid FROM refs WHERE key = ?', (key,)))
 
-        # Get keywords inside this document
-        cursor.execute('SELECT key FROM refs WHERE uuid = ?', (uuid,))
+        pages = self.find_mentions(displayname) - linked
+        pages.discard(uuid)
 
-        rows = cursor.fetchall()
+        return sorted(pages)
 
-        # TODO: Can this be replaced by an IN clause?
-        links = []
+    def get_backlinks(self, uuid):
+        # The LEFT JOIN yields a single NULL row for a page without backlinks,
+        # and no rows at all for an unknown page.
+        with self.reader() as connection:
+            rows = connection.execute('''SELECT r.uuid FROM items i LEFT JOIN refs r ON r.key = i.key
+                                         WHERE i.uuid = ? ORDER BY r.rowid''', (uuid,)).fetchall()
+        if len(rows) == 0:
+            return None
 
-        for r in rows:
-            key = r[0]
-            cursor.execute('SELECT uuid FROM items WHERE key = ? AND uuid != ?', (key, uuid))
-            tmp = cursor.fetchone()
-            if tmp is None:
-                continue
-            links.append(tmp[0])
+        return [r[0] for r in rows if r[0] is not None]
 
-        return links
+    def get_forwardlinks(self, uuid):
+        # Each keyword inside this document links to one other page with that
+        # key.
+        with self.reader() as connection:
+            rows = connection.execute('''SELECT MIN(i.uuid) FROM refs r JOIN items i ON i.key = r.key AND i.uuid != r.uuid
+                                         WHERE r.uuid = ? GROUP BY r.key ORDER BY MIN(r.rowid)''', (uuid,))
+            return [r[0] for r in rows]
+
+    # Returns the forward and backward links of every page as two dicts that
+    # map a page UUID to a list of (uuid, displayname) tuples, using one query
+    # for each direction. Pages without links do not appear in the dicts.
+    def link_graph(self):
+        forward = {}
+        backward = {}
+
+        with self.reader() as connection:
+            rows = connection.execute('''SELECT r.uuid, MIN(i.uuid), i.displayname FROM refs r
+                                         JOIN items i ON i.key = r.key AND i.uuid != r.uuid
+                                         GROUP BY r.uuid, r.key ORDER BY r.uuid, MIN(r.rowid)''')
+            for source, target, displayname in rows:
+                forward.setdefault(source, []).append((target, displayname))
+
+            rows = connection.execute('''SELECT i.uuid, r.uuid, s.displayname FROM items i
+                                         JOIN refs r ON r.key = i.key
+                                         LEFT JOIN items s ON s.uuid = r.uuid
+                                         ORDER BY i.uuid, r.rowid''')
+            for target, source, displayname in rows:
+                backward.setdefault(target, []).append((source, displayname))
+
+        return forward, backward
 
     # Get the keywords that appear in the document with the given UUID
     def get_links(self, uuid):
-        connection = self.get_connection()
-        cursor = connection.cursor()
-
-        cursor.execute('SELECT key, wikiword FROM refs WHERE uuid = ?', (uuid,))
-        rows = cursor.fetchall()
+        with self.reader() as connection:
+            rows = connection.execute('SELECT key, wikiword FROM refs WHERE uuid = ?', (uuid,)).fetchall()
 
         links = {}
         for r in rows:
@@ -176,25 +643,38 @@ class VPCache:
 
         return links
 
+    # Returns the cached markdown for the page with the given UUID, or None if
+    # the page was not rendered from the given page and link hashes.
+    def get_rendered(self, uuid, data_hash, link_hash):
+        with self.reader() as connection:
+            row = connection.execute('SELECT markdown FROM rendered WHERE uuid = ? AND dataHash = ? AND linkHash = ?',
+                                     (uuid, data_hash, link_hash)).fetchone()
+
+        return row[0] if row is not None else None
+
+    # Store rendered pages, given as (uuid, dataHash, linkHash, markdown)
+    # tuples.
+    def put_rendered(self, rows):
+        with self.bulk_transaction() as cursor:
+            cursor.executemany('INSERT OR REPLACE INTO rendered VALUES(?, ?, ?, ?)', rows)
+
     # Dump tables contents to stdout
     def dump_tables(self):
-        connection = self.get_connection()
-        cursor = connection.cursor()
-
-        rows = cursor.execute('SELECT * FROM items')
-        for r in rows:
-            print(r)
+        with self.reader() as connection:
+            rows = connection.execute('SELECT * FROM items')
+            for r in rows:
+                print(r)
 
-        rows = cursor.execute('SELECT * FROM refs')
-        for r in rows:
-            print(r)
+            rows = connection.execute('SELECT * FROM refs')
+            for r in rows:
+                print(r)
 
 
 def get_wikiword_map(ds):
     keywords = {}
-    for uuid in ds.item_uuids():
+    for uuid, _, text in ds.iter_items():
 
-        words = get_wikiwords(ds, uuid)
+        words = get_wikiwords(ds, uuid, text)
 
         for w in words:
             if w not in keywords:
@@ -215,10 +695,15 @@ def get_page_names(ds):
     return names
 
 
-# Returns an array of wikiwords in the document
-def get_wikiwords(ds, uuid):
-    text = ds.item(uuid)
-    item = tokenizer.VPItem(text, ds.trie)
+# Returns an array of wikiwords in the document. Pass the page text if the
+# caller already has it (e.g., from DataStore.iter_items()), otherwise the
+# page is tokenized straight from a memory-mapped view of the file.
+def get_wikiwords(ds, uuid, text=None):
+    if text is None:
+        with ds.item_view(uuid) as view:
+            item = tokenizer.VPItem(view, ds.title_trie())
+    else:
+        item = tokenizer.VPItem(text, ds.title_trie())
 
     return item.item_keywords()
 
@@ -277,134 +762,253 @@ class VoodooPad:
 
         return False
 
-    # Convert the page to markdown
-    def render_page(self, ds, cache, uuid):  # noqa: C901
-
-        # p = ds.item_path(uuid)
-
+    # Convert the page to markdown, turning the keywords the page links to
+    # (see VPCache.get_links()) into links to the rendered pages. The page is
+    # tokenized once and the links are placed at the word offsets of the
+    # keywords found in it.
+    def render_page(self, ds, cache, uuid, text=None, links=None):
         plist = ds.item_plist(uuid)
 
         page_key = plist['key']
 
-        text = ds.item(uuid)
+        if text is None:
+            text = ds.item(uuid)
 
-        links = cache.get_links(uuid)
+        if links is None:
+            links = cache.get_links(uuid)
 
-        # We are doing a case-insensitive search. Convert the text to lower case.
-        text_lower = text.lower()
-        indexes = {}
+        item = tokenizer.VPItem(text, ds.title_trie())
+        stream = item.stream
 
-        # Locate the keywords in the text and store the index
-        for key in links:
-            idx = 0
+        pieces = []
+        copied = 0
+        next_word = 0
+        for start in sorted(item.spans):
+            # Skip keywords that overlap a link already made.
+            if start < next_word:
+                continue
+
+            end = item.spans[start]
+            key = ' '.join(stream.folded(i) for i in range(start, end))
 
             # Do not link this document to itself
-            if key == page_key:
+            if key == page_key or key not in links:
                 continue
 
-            while True:
-                idx = text_lower.find(key, idx)
-                if idx == -1:
-                    break
+            target = ds.find_by_key(key)
+            if target is None:
+                continue
+            url = slugify(ds.item_plist(target)['displayName']) + '.md'
 
-                # If the word is a markdown link target and it's the only thing in the link target, then we
-                # want to replace the link target with the file name e.g. [Napoleon](Napoleon) becomes
-                # [Napoleon](Napoleon.md)
-                if idx >= 2 and idx + len(key) < len(text) and text[idx - 1] == '(' and text[idx + len(key)] == ')' and text[idx - 2] == ']':
-                    indexes[idx] = key
-                    idx = idx + len(key)
-                    continue
+            # Only link names whose words are separated by spaces.
+            if any(not text[stream.ends[i]:stream.starts[i + 1]].isspace() for i in range(start, end - 1)):
+                continue
 
-                # Ignore if it's part of a bigger word but accept if its surrounded by punctuation.
-                # TODO: Is there a better way to do this?
-                if (idx != 0 and text[idx - 1] not in [' ','\n', '\r']) or (idx + len(key) < len(text) and text[idx + len(key)] not in [' ', '.', ',','\n', '\r']):
-                    idx = idx + len(key)
-                    continue
+            idx = stream.starts[start]
+            idx_end = stream.ends[end - 1]
 
+            if idx >= 2 and idx_end < len(text) and text[idx - 1] == '(' and text[idx_end] == ')' and text[idx - 2] == ']':
+                # If the word is a markdown link target and it's the only thing in the link target, then
+                # replace the link target with the file name e.g. [Napoleon](Napoleon) becomes
+                # [Napoleon](napoleon.md)
+                replacement = url
+            elif self.in_markdown_link(text, idx):
                 # Ignore if already inside a markdown link
-                if self.in_markdown_link(text, idx):
-                    idx = idx + len(key)
-                    continue
+                continue
+            else:
+                replacement = self.markdown_link(text[idx:idx_end], url)
 
-                indexes[idx] = key
-                idx = idx + len(key)
+            pieces.append(text[copied:idx])
+            pieces.append(replacement)
+            copied = idx_end
+            next_word = end
 
-        # Nothing to do if no keywords were found
-        if len(indexes) == 0:
+        if not pieces:
             return text
 
-        # Replacing keywords will change the length of the text and change the positions of the
-        # other keywords. Sort the indexes so that we can do a single scan over the text and
-        # replace keywords as they appear, keeping track of the change in position.
-        sorted_keys = list(indexes.keys())
-        sorted_keys.sort()
-
-        sorted_indexes = []
-
-        for k in sorted_indexes:
-            sorted_indexes.append({'index': k, 'key': indexes[k]})
-
-        offset = 0
-        for s in sorted_indexes:
-
-            idx = s['index']
-            key = s['key']
-
-            if text[idx + offset - 1] == '(' and text[idx + offset + len(key)] == ')' and text[idx + offset - 2] == ']':
-                # Replace link inside of a markdown link
-                replacement = links[key] + '.md'
-                text = text[:idx + offset] + links[key] + '.md' + text[idx + offset + len(key):]
-                offset = offset + len(replacement) - len(key)
-            else:
-                # Add a markdown link
-                word = text[idx + offset:idx + offset + len(key)]
-                markdown = self.markdown_link(word, links[key] + '.md')
-                text = text[:idx + offset] + markdown + text[idx + offset + len(key):]
-                offset = offset + len(markdown) - len(key)
-
-        return text
+        pieces.append(text[copied:])
+        return ''.join(pieces)
 
+    # Render every page to a markdown file in output_dir. Pages whose text and
+    # links have not changed since they were last rendered are taken from the
+    # cache without reading the page, and files that already hold the
+    # rendered markdown are left untouched. Returns the number of pages
+    # rendered, taken from the cache and written.
     def render_document(self, output_dir):
         if not os.path.exists(output_dir):
             os.mkdir(output_dir)
 
-        for uuid in self.ds_.item_uuids():
+        stats = {'rendered': 0, 'cached': 0, 'written': 0}
+
+        def write(plist, markdown):
+            path = os.path.join(output_dir, f'{slugify(plist["displayName"])}.md')
+            data = markdown.encode('utf-8')
+            if os.path.isfile(path) and os.path.getsize(path) == len(data) and datastore.sha1_file(path) == datastore.sha1_hash(data):
+                return
+            with open(path, 'wb') as f:
+                f.write(data)
+            stats['written'] += 1
+
+        stale = {}
+        for uuid in sorted(self.ds_.item_uuids()):
+            if not self.ds_.has_body(uuid):
+                continue
             plist = self.ds_.item_plist(uuid)
-            display_name = plist['displayName']
-            text = self.render_page(self.ds_, self.cache_, uuid)
-            path = os.path.join(output_dir, f'{slugify(display_name)}.md')
-            with open(path, 'w') as f:
-                f.write(text)
+            links = self.cache_.get_links(uuid)
+            digest = link_hash(self.ds_, plist['key'], links)
+            markdown = self.cache_.get_rendered(uuid, plist.get('dataHash'), digest)
+            if markdown is None:
+                stale[uuid] = (links, digest)
+                continue
+            stats['cached'] += 1
+            write(plist, markdown)
+
+        # Stale pages are rendered and stored a chunk at a time, so only one
+        # chunk of markdown is held in memory at once.
+        for chunk in self.ds_.iter_item_chunks(RENDER_CHUNK_SIZE, stale):
+            rows = []
+            for uuid, plist, text in chunk:
+                links, digest = stale[uuid]
+                markdown = self.render_page(self.ds_, self.cache_, uuid, text, links)
+                rows.append((uuid, plist.get('dataHash'), digest, markdown))
+                stats['rendered'] += 1
+                write(plist, markdown)
+            self.cache_.put_rendered(rows)
+
+        return stats
 
     def add_item(self, ds, name, text, format=PageFormat.Plaintext):
-        for item in self.ds_.item_plists.values():
-            if item['displayName'].lower() == name.lower():
-                print('A page with that name already exists')
-                return
+        if self.ds_.find_by_name(name) is not None:
+            print('A page with that name already exists')
+            return
 
         self.ds_.add_item(name, text, format)
 
+    # Returns a context manager for adding many pages at once. The pages are
+    # added to the cache (and the trie rebuilt) once, when the batch exits.
+    @contextlib.contextmanager
+    def batch(self):
+        with self.ds_.batch() as batch:
+            yield batch
+
+        self.cache_.update_cache(self.ds_)
+
+    # Add every (name, text, format) tuple in items in a single batch.
+    def add_items(self, items):
+        with self.batch() as batch:
+            return batch.add_items(items)
+
     def render(self, output_dir):
         self.cache_.update_cache(self.ds_)
-        self.render_document(output_dir)
+        return self.render_document(output_dir)
 
     def print_info(self):
         print('Path: {}'.format(self.ds_.path))
         print('Info: {}'.format(self.ds_.storeinfo))
         print('Properties: {}'.format(self.ds_.properties))
 
-        print('Valid: {}'.format(self.ds_.validate()))
+        # Info only runs the structural checks. Page bodies are hashed by the
+        # validate command.
+        print('Valid: {}'.format(self.ds_.validate(hash_bodies=False)))
         uuids = self.ds_.item_uuids()
 
+        forward, backward = self.cache_.link_graph()
+
         for uuid in uuids:
             print(self.ds_.item_plist(uuid)['displayName'], 'links to:')
-            for id in self.cache_.get_forwardlinks(uuid):
-                print(id, self.ds_.item_plist(id)['displayName'])
+            for id, displayname in forward.get(uuid, []):
+                print(id, displayname)
 
         for uuid in uuids:
             print(self.ds_.item_plist(uuid)['displayName'], ' backlinks to:')
-            for id in self.cache_.get_backlinks(uuid):
-                print(id, self.ds_.item_plist(id)['displayName'])
+            for id, displayname in backward.get(uuid, []):
+                print(id, displayname)
+
+    # Print the pages matching a full-text search query.
+    def search(self, query, limit=20):
+        try:
+            results = self.cache_.search(query, limit)
+        except sqlite3.Error as e:
+            print(f'Search failed: {e}')
+            return
+
+        for uuid, snippet in results:
+            print(self.ds_.item_plist(uuid)['displayName'])
+            print('    ' + ' '.join(snippet.split()))
+
+    def graph(self):
+        return LinkGraph.from_cache(self.cache_)
+
+    def print_pages(self, graph, pages):
+        for v in pages:
+            print(graph.uuids[v], graph.names[v])
+
+    # Print the limit pages with the highest PageRank.
+    def print_pagerank(self, limit=20):
+        graph = self.graph()
+        rank = graph.pagerank()
+        for v in sorted(range(len(graph)), key=lambda v: -rank[v])[:limit]:
+            print(f'{rank[v]:.6f}', graph.uuids[v], graph.names[v])
+
+    # Print the pages no other page links to.
+    def print_orphans(self):
+        graph = self.graph()
+        self.print_pages(graph, graph.orphans())
+
+    # Print the pages that do not link to any other page.
+    def print_dead_ends(self):
+        graph = self.graph()
+        self.print_pages(graph, graph.dead_ends())
+
+    # Print the limit largest groups of pages that can all reach each other
+    # through links.
+    def print_components(self, limit=20):
+        graph = self.graph()
+        components = [c for c in graph.strongly_connected_components() if len(c) > 1]
+        components.sort(key=len, reverse=True)
+        for i, component in enumerate(components[:limit]):
+            print(f'Component {i + 1} ({len(component)} pages):')
+            self.print_pages(graph, sorted(component))
+
+    # Print the shortest chain of links from the page named source to the page
+    # named target.
+    def print_path(self, source, target):
+        graph = self.graph()
+
+        pages = []
+        for name in [source, target]:
+            uuid = self.ds_.find_by_name(name) if name else None
+            if uuid is None:
+                print(f'No page named {name}')
+                return
+            pages.append(graph.ids[uuid])
+
+        path = graph.shortest_path(pages[0], pages[1])
+        if path is None:
+            print(f'{source} does not link to {target}')
+            return
+
+        self.print_pages(graph, path)
+
+    # Check the integrity of the document. Prints the report as JSON if
+    # as_json is True. Returns True if the document is valid.
+    def validate(self, workers=None, incremental=False, as_json=False):
+        def progress(done, total):
+            if done % 100 == 0 or done == total:
+                print(f'\rChecked {done}/{total} pages', end='', file=sys.stderr)
+            if done == total:
+                print(file=sys.stderr)
+
+        report = self.ds_.check(workers, progress if sys.stderr.isatty() else None, incremental)
+
+        if as_json:
+            print(json.dumps(report.to_dict(), indent=2))
+        else:
+            for issue in report.issues:
+                print('[WARN] {}'.format(issue['message']))
+            print('Valid: {}'.format(report.valid))
+
+        return report.valid
 
     def add_file(self, path, name, format):
         with open(path, 'rb') as f:
@@ -413,15 +1017,12 @@ class VoodooPad:
         self.add(text, name, format)
 
     def add(self, text, name, format):
-        if format == 'plaintext':
-            format = PageFormat.Plaintext
-        elif format == 'markdown':
-            format = PageFormat.MarkDown
-        else:
+        uti = page_format(format)
+        if uti is None:
             print('Invalid format ', format)
             return
 
-        self.add_item(self.ds_, name, text, format)
+        self.add_item(self.ds_, name, text, uti)
 
 
 def main():
@@ -430,9 +1031,17 @@ def main():
     parser.add_argument('command', nargs='?', default=None, help='command')
     parser.add_argument('--file', help='file')
     parser.add_argument('--format', default='plaintext', help='format')
+    parser.add_argument('--incremental', action='store_true', help='only check pages modified since the last clean validate')
+    parser.add_argument('--json', action='store_true', help='print machine-readable output')
+    parser.add_argument('--limit', type=int, default=20, help='maximum number of results to print')
     parser.add_argument('--output', default=None, help='output')
     parser.add_argument('--password', help='password')
+    parser.add_argument('--query', help='search query')
+    parser.add_argument('--source', help='name of the page a path starts at')
+    parser.add_argument('--target', help='name of the page a path ends at')
     parser.add_argument('--title', help='title')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write cache.db; index the document in memory')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes used to open the document')
 
     args = parser.parse_args()
 
@@ -441,8 +1050,9 @@ def main():
         return
 
     vp = VoodooPad(None, None)
-    vp.ds_ = datastore.DataStore.open(args.document, args.password)
-    vp.cache_ = VPCache(args.document, True)
+    vp.ds_ = datastore.DataStore.open(args.document, args.password, in_memory=args.no_cache, workers=args.workers,
+                                      trie_snapshot=True)
+    vp.cache_ = VPCache(args.document, args.no_cache)
     vp.cache_.update_cache(vp.ds_)
 
     if args.command is None:
@@ -451,9 +1061,28 @@ def main():
         vp.add_file(args.file, args.title, args.format)
     elif args.command == 'render':
         vp.render(args.output)
+    elif args.command == 'search':
+        vp.search(args.query, args.limit)
+    elif args.command == 'pagerank':
+        vp.print_pagerank(args.limit)
+    elif args.command == 'orphans':
+        vp.print_orphans()
+    elif args.command == 'deadends':
+        vp.print_dead_ends()
+    elif args.command == 'components':
+        vp.print_components(args.limit)
+    elif args.command == 'path':
+        vp.print_path(args.source, args.target)
+    elif args.command == 'validate':
+        if not vp.validate(args.workers, args.incremental, args.json):
+            sys.exit(1)
     else:
         print(f'Unknown command \'{args.command}\'')
 
+    # Commands that add pages change the titles. Save the trie so the next
+    # run can load it rather than build it.
+    vp.ds_.save_title_trie()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from datastore import DataStore, sha1_hash
+import voodoopad
+from voodoopad import CACHE_SCHEMA_VERSION, PageFormat, VoodooPad, VPCache, get_wikiwords
+
+
+class VoodooPadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'Test.vpdoc')
+
+        ds = DataStore.create(self.path)
+        self.apple = ds.add_item('Apple', 'Makes computers like the commodore amiga', PageFormat.MarkDown)
+        self.atari = ds.add_item('Atari', 'Atari competed with apple', PageFormat.MarkDown)
+        self.falcon = ds.add_item('Atari Falcon', 'The Atari Falcon was made by atari', PageFormat.MarkDown)
+
+        self.vp = VoodooPad(self.path, in_memory=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # Change the text of a page behind the cache's back.
+    def update_page(self, uuid, text):
+        ds = self.vp.ds_
+        ds.save_file(text.encode('utf-8'), ds.item_path(uuid))
+        ds.item_plist(uuid)['dataHash'] = sha1_hash(text)
+        ds.item_cache.discard(uuid)
+
+    def test_links(self):
+        cache = self.vp.cache_
+        self.assertEqual(cache.get_backlinks(self.apple), [self.atari])
+        self.assertEqual(cache.get_forwardlinks(self.falcon), [self.atari])
+
+    def test_link_graph(self):
+        forward, backward = self.vp.cache_.link_graph()
+
+        for uuid in [self.apple, self.atari, self.falcon]:
+            self.assertEqual([u for u, _ in forward.get(uuid, [])], self.vp.cache_.get_forwardlinks(uuid))
+            self.assertEqual([u for u, _ in backward.get(uuid, [])], self.vp.cache_.get_backlinks(uuid))
+
+        self.assertEqual(forward[self.falcon], [(self.atari, 'Atari')])
+
+    def test_update_cache(self):
+        cache = self.vp.cache_
+
+        self.update_page(self.atari, 'Atari made the Atari ST')
+        cache.update_cache(self.vp.ds_)
+        self.assertEqual(cache.get_backlinks(self.apple), [])
+
+        row = cache.get_connection().execute('SELECT dataHash FROM items WHERE uuid = ?', (self.atari,)).fetchone()
+        self.assertEqual(row[0], sha1_hash('Atari made the Atari ST'))
+
+        # Deleted pages are purged from the cache.
+        del self.vp.ds_.item_plists[self.falcon]
+        cache.update_cache(self.vp.ds_)
+        self.assertIsNone(cache.get_backlinks(self.falcon))
+        self.assertEqual(cache.get_links(self.falcon), {})
+
+    def test_title_changes(self):
+        ds = self.vp.ds_
+        cache = self.vp.cache_
+        trie = ds.title_trie()
+
+        # Adding a page re-scans only the pages that mention its first word.
+        commodore = ds.add_item('Commodore Amiga', 'A home computer', PageFormat.MarkDown)
+        self.assertEqual(cache.update_cache(ds), 2)
+        self.assertEqual(cache.get_backlinks(commodore), [self.apple])
+
+        # Nothing changed, so nothing is tokenized.
+        self.assertEqual(cache.update_cache(ds), 0)
+
+        # Renaming it removes the old title and adds the new one.
+        ds.rename_item(commodore, 'Amiga')
+        cache.update_cache(ds)
+        self.assertEqual(cache.get_backlinks(commodore), [self.apple])
+        self.assertEqual(cache.get_links(self.apple), {'amiga': 'amiga'})
+
+        # Deleting a page re-scans the pages that linked to it.
+        ds.delete_item(self.atari)
+        cache.update_cache(ds)
+        self.assertEqual(cache.get_links(self.falcon), {'atari falcon': 'atari falcon'})
+        self.assertIsNone(cache.get_backlinks(self.atari))
+
+        # The title trie was kept up to date rather than rebuilt.
+        self.assertIs(ds.title_trie(), trie)
+
+    def test_wikiwords_nbsp(self):
+        # Reading the page from disk finds the same keywords as passing its
+        # text, even when a no-break space separates the words of a name.
+        ds = self.vp.ds_
+        text = 'Made by Atari\u00a0Falcon fans'
+        self.update_page(self.apple, text)
+        self.assertEqual(sorted(get_wikiwords(ds, self.apple)), sorted(get_wikiwords(ds, self.apple, text)))
+        self.assertIn('atari falcon', get_wikiwords(ds, self.apple))
+
+    def test_mentions(self):
+        cache = self.vp.cache_
+
+        self.assertEqual(cache.pages_with_words({'competed'}), {self.atari})
+        self.assertEqual(cache.find_mentions('Atari Falcon'), {self.falcon})
+
+        # The Atari Falcon page mentions 'atari' twice but only the second
+        # mention is linked, so it is not an unlinked mention.
+        self.assertEqual(cache.unlinked_mentions(self.atari), [])
+
+        # The words of a title do not have to be adjacent.
+        ds = self.vp.ds_
+        uuid = ds.add_item('Falcon Atari', 'Not the Atari Falcon', PageFormat.MarkDown)
+        cache.update_cache(ds)
+        self.assertEqual(cache.unlinked_mentions(uuid), [self.falcon])
+
+    def test_persistent_cache(self):
+        cache = VPCache(self.path)
+        connection = cache.get_connection()
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(cache.update_cache(self.vp.ds_), 4)
+        cache.close()
+
+        # A second run over an unchanged document tokenizes nothing.
+        ds = DataStore.open(self.path)
+        cache = VPCache(self.path)
+        self.assertEqual(cache.update_cache(ds), 0)
+        self.assertEqual(cache.get_backlinks(self.apple), [self.atari])
+        cache.close()
+
+    def test_search(self):
+        cache = self.vp.cache_
+
+        results = cache.search('competed')
+        self.assertEqual(results, [(self.atari, 'Atari [competed] with apple')])
+
+        # Titles are searched too, and the index follows changes.
+        ds = self.vp.ds_
+        ds.rename_item(self.apple, 'Macintosh')
+        self.update_page(self.atari, 'Atari made the Atari ST')
+        cache.update_cache(ds)
+
+        self.assertEqual(cache.search('competed'), [])
+        self.assertEqual([uuid for uuid, _ in cache.search('macintosh')], [self.apple])
+
+        ds.delete_item(self.apple)
+        cache.update_cache(ds)
+        self.assertEqual(cache.search('macintosh'), [])
+
+    def test_render_page(self):
+        ds = self.vp.ds_
+        cache = self.vp.cache_
+
+        self.assertEqual(self.vp.render_page(ds, cache, self.atari), 'Atari competed with [apple](apple.md)')
+
+        # The page's own name is not linked, even where it contains the name
+        # of another page.
+        self.assertEqual(self.vp.render_page(ds, cache, self.falcon), 'The Atari Falcon was made by [atari](atari.md)')
+
+        # Markdown links to a page name point at the rendered page instead.
+        self.update_page(self.atari, 'See [Apple](Apple) or [the Falcon](atari falcon)\nAtari  Falcon.')
+        cache.update_cache(ds)
+        self.assertEqual(self.vp.render_page(ds, cache, self.atari),
+                         'See [Apple](apple.md) or [the Falcon](atari-falcon.md)\n[Atari  Falcon](atari-falcon.md).')
+
+    def test_render_cache(self):
+        output = os.path.join(self.tmp.name, 'output')
+
+        # The document has an index page as well.
+        stats = self.vp.render(output)
+        self.assertEqual(stats, {'rendered': 4, 'cached': 0, 'written': 4})
+
+        stats = self.vp.render(output)
+        self.assertEqual(stats, {'rendered': 0, 'cached': 4, 'written': 0})
+
+        # A changed page is rendered again. A missing file is written from
+        # the cache.
+        self.update_page(self.apple, 'Apple was founded in 1976')
+        os.remove(os.path.join(output, 'atari.md'))
+        stats = self.vp.render(output)
+        self.assertEqual(stats, {'rendered': 1, 'cached': 3, 'written': 2})
+
+        # Adding a page changes the links of the pages that mention it.
+        self.vp.add_item(self.vp.ds_, 'Founded', 'Founded by', PageFormat.MarkDown)
+        self.vp.cache_.update_cache(self.vp.ds_)
+        stats = self.vp.render(output)
+        self.assertEqual(stats['rendered'], 2)
+
+    def test_render_chunks(self):
+        output = os.path.join(self.tmp.name, 'output')
+
+        # Rendered pages are stored a chunk at a time.
+        chunks = []
+        put_rendered = self.vp.cache_.put_rendered
+
+        def put_chunk(rows):
+            chunks.append(len(rows))
+            put_rendered(rows)
+
+        self.vp.cache_.put_rendered = put_chunk
+        chunk_size = voodoopad.RENDER_CHUNK_SIZE
+        voodoopad.RENDER_CHUNK_SIZE = 3
+        try:
+            stats = self.vp.render(output)
+        finally:
+            voodoopad.RENDER_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(chunks, [3, 1])
+        self.assertEqual(self.vp.render(output)['cached'], stats['rendered'])
+
+    def test_render_renamed_target(self):
+        output = os.path.join(self.tmp.name, 'output')
+        self.vp.render(output)
+
+        # Renaming a page changes where the pages that link to it point, even
+        # before the links in the cache are brought up to date. The renamed
+        # page and the page linking to it are rendered again.
+        self.vp.ds_.rename_item(self.apple, 'Macintosh')
+        stats = self.vp.render_document(output)
+        self.assertEqual(stats['rendered'], 2)
+        with open(os.path.join(output, 'atari.md')) as f:
+            self.assertEqual(f.read(), 'Atari competed with apple')
+
+    def test_concurrent_readers(self):
+        ds = self.vp.ds_
+        expected = {uuid: self.vp.cache_.get_backlinks(uuid) for uuid in [self.apple, self.atari, self.falcon]}
+
+        for in_memory in [True, False]:
+            cache = VPCache(self.path, in_memory, readers=2)
+            cache.update_cache(ds)
+
+            results = []
+
+            def run():
+                for _ in range(50):
+                    for uuid in expected:
+                        results.append(cache.get_backlinks(uuid) == expected[uuid])
+
+            threads = [threading.Thread(target=run) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(results), 600)
+            self.assertTrue(all(results))
+
+            # In-memory caches serve queries from the writer connection.
+            stats = cache.reader_stats()
+            if in_memory:
+                self.assertIsNone(stats)
+            else:
+                self.assertLessEqual(stats['connections'], 2)
+                self.assertGreaterEqual(stats['acquired'], 600)
+            cache.close()
+
+    def test_reader_pool_close(self):
+        cache = VPCache(self.path)
+        cache.update_cache(self.vp.ds_)
+
+        # A connection in use when the pool is closed is closed when it is
+        # returned rather than handed out again.
+        with cache.reader() as connection:
+            cache.close()
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM items').fetchone()[0], 4)
+
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+        with self.assertRaises(sqlite3.ProgrammingError):
+            cache.get_backlinks(self.apple)
+
+    def test_cache_migration(self):
+        db_path = os.path.join(self.path, 'cache.db')
+
+        # A cache written before the schema was versioned.
+        connection = sqlite3.connect(db_path)
+        connection.execute('CREATE TABLE items(uuid TEXT, key TEXT, displayname TEXT, dataHash TEXT)')
+        connection.execute('CREATE TABLE refs(wikiword TEXT, uuid TEXT, key TEXT)')
+        connection.execute("INSERT INTO items VALUES ('stale', 'stale', 'Stale', '')")
+        connection.commit()
+        connection.close()
+
+        cache = VPCache(self.path)
+        connection = cache.get_connection()
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], CACHE_SCHEMA_VERSION)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM items').fetchone()[0], 0)
+
+        cache.update_cache(self.vp.ds_)
+        self.assertEqual(cache.get_backlinks(self.apple), [self.atari])
+        cache.close()
+
+        # Files that are not caches at all are replaced, along with any
+        # journal files beside them.
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            with open(db_path + suffix, 'wb') as f:
+                f.write(b'not a database')
+
+        cache = VPCache(self.path)
+        cache.update_cache(self.vp.ds_)
+        self.assertEqual(cache.get_backlinks(self.apple), [self.atari])
+        cache.close()
+        for suffix in ('-journal', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                with open(db_path + suffix, 'rb') as f:
+                    self.assertFalse(f.read().startswith(b'not a database'))
+
+        # Caches written by a newer version are replaced.
+        connection = sqlite3.connect(db_path)
+        connection.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION + 1}')
+        connection.close()
+
+        cache = VPCache(self.path)
+        connection = cache.get_connection()
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], CACHE_SCHEMA_VERSION)
+        cache.close()
+
+    def test_cache_locked(self):
+        db_path = os.path.join(self.path, 'cache.db')
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+        # A cache another process is writing to is left alone.
+        connection = sqlite3.connect(db_path, isolation_level=None)
+        connection.execute('CREATE TABLE other(value)')
+        connection.execute('BEGIN EXCLUSIVE')
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                VPCache(self.path, pragmas={'busy_timeout': 0})
+            self.assertTrue(os.path.isfile(db_path))
+        finally:
+            connection.execute('ROLLBACK')
+            connection.close()
+
+        connection = sqlite3.connect(db_path)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM other').fetchone()[0], 0)
+        connection.close()
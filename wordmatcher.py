@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from array import array
+from collections import deque
+
+
+# Shared by every node without children. Never modified.
+NO_CHILDREN = {}
+
+
+# An Aho-Corasick automaton over words, compiled from the names in a
+# WordTrie. find() reports every name in a sequence of words in a single pass,
+# however many names overlap, where walking the trie from every word costs up
+# to the length of the longest name per word.
+#
+# Nodes are numbered from 0 (the root) in breadth-first order. children[v]
+# maps a word to the next node, fail[v] is the node for the longest proper
+# suffix of v's words that is also a prefix of a name, and output[v] is the
+# nearest node along the failure links that ends a name (0 if there is none).
+class WordMatcher:
+    def __init__(self, trie):
+        self.children = []
+        self.fail = array('i')
+        self.depth = array('i')
+        self.output = array('i')
+        self.names = {}
+
+        root = self.add_node(trie, 0, 0, ())
+        pending = deque([(0, root, ())])
+
+        while pending:
+            trie_node, node, words = pending.popleft()
+            for word, trie_child in trie.children(trie_node):
+                child_words = words + (word,)
+                child = self.add_node(trie, trie_child, len(child_words), child_words)
+                self.children[node][word] = child
+
+                if node != root:
+                    fail = self.fail[node]
+                    while fail and word not in self.children[fail]:
+                        fail = self.fail[fail]
+                    self.fail[child] = self.children[fail].get(word, root)
+
+                fail = self.fail[child]
+                self.output[child] = fail if fail in self.names else self.output[fail]
+
+                if trie.first_child[trie_child] != -1:
+                    pending.append((trie_child, child, child_words))
+
+    def add_node(self, trie, trie_node, depth, words):
+        node = len(self.children)
+        self.children.append({} if trie.first_child[trie_node] != -1 else NO_CHILDREN)
+        self.fail.append(0)
+        self.depth.append(depth)
+        self.output.append(0)
+        if trie.word_counts[trie_node] > 0 and depth > 0:
+            self.names[node] = ' '.join(words)
+        return node
+
+    def __len__(self):
+        return len(self.children)
+
+    # Yields a (name, start, end) tuple for every name in words, an iterable
+    # of words normalized the same way as the names in the trie, where
+    # words[start:end] is the name. Names are reported in order of their end,
+    # longest first.
+    def find(self, words):
+        children = self.children
+        fail = self.fail
+        depth = self.depth
+        output = self.output
+        names = self.names
+
+        node = 0
+        end = 0
+        for word in words:
+            end += 1
+
+            while node and word not in children[node]:
+                node = fail[node]
+            node = children[node].get(word, 0)
+
+            match = node if node in names else output[node]
+            while match:
+                yield names[match], end - depth[match], end
+                match = output[match]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import unittest
+
+from wordmatcher import WordMatcher
+from wordtrie import WordTrie
+
+
+class WordMatcherTest(unittest.TestCase):
+    def matcher(self, names):
+        trie = WordTrie()
+        for name in names:
+            trie.add(name.split())
+        return WordMatcher(trie)
+
+    def test_find(self):
+        matcher = self.matcher(['atari', 'atari st', 'atari falcon', 'video game', 'video game crash'])
+
+        words = 'the atari st and the video game crash'.split()
+        self.assertEqual(list(matcher.find(words)), [
+            ('atari', 1, 2),
+            ('atari st', 1, 3),
+            ('video game', 5, 7),
+            ('video game crash', 5, 8),
+        ])
+
+        self.assertEqual(list(matcher.find([])), [])
+        self.assertEqual(list(matcher.find(['falcon'])), [])
+
+    def test_overlapping_names(self):
+        # Names that end inside other names are found through the failure
+        # links.
+        matcher = self.matcher(['a b c', 'b c d', 'c', 'b'])
+
+        words = 'a b c d'.split()
+        self.assertEqual(sorted(matcher.find(words)), [
+            ('a b c', 0, 3),
+            ('b', 1, 2),
+            ('b c d', 1, 4),
+            ('c', 2, 3),
+        ])
+
+        # A failed partial match falls back to the longest suffix that can
+        # still match.
+        words = 'a b b c d'.split()
+        self.assertEqual(sorted(matcher.find(words)), [
+            ('b', 1, 2),
+            ('b', 2, 3),
+            ('b c d', 2, 5),
+            ('c', 3, 4),
+        ])
+
+    def test_empty_trie(self):
+        matcher = WordMatcher(WordTrie())
+        self.assertEqual(len(matcher), 1)
+        self.assertEqual(list(matcher.find(['atari'])), [])
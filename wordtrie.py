@@ -20,47 +20,324 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+from array import array
+from bisect import bisect_left
+import itertools
+import struct
+import sys
+
+
+# Edges are keyed by (node << EDGE_SHIFT) | word id, so a key is a single int
+# rather than a tuple.
+EDGE_SHIFT = 32
+
+
+# The smallest number of new edges kept in the insert buffer of a WordTrie
+# before they are merged into its sorted edge arrays. The buffer may also grow
+# to an eighth of the number of edges, so merges stay rare as the trie grows.
+EDGE_BUFFER_SIZE = 1024
+
+
+# A trie snapshot starts with the magic number, the tag and version it was
+# saved with, and the number of nodes, free nodes, edges and words and the
+# length of the word text. The arrays follow in little-endian order: the node arrays, the
+# free list, the edge keys in sorted order and their child nodes, and the
+# end offset of every word in the word text. The UTF-8 word text comes last.
+SNAPSHOT_MAGIC = b'VPTRIE02'
+SNAPSHOT_HEADER = struct.Struct('<8s20sQQQQQQ')
+
+
+# A view of one node of a WordTrie. words is the number of names ending at
+# the node and prefixes the number of names that continue past it.
 class WordTrieBranch:
-    def __init__(self):
-        self.words = 0
-        self.prefixes = 0
-        self.branches = {}
+    __slots__ = ('trie', 'node')
+
+    def __init__(self, trie, node):
+        self.trie = trie
+        self.node = node
+
+    @property
+    def words(self):
+        return self.trie.word_counts[self.node]
+
+    @property
+    def prefixes(self):
+        return self.trie.prefix_counts[self.node]
 
     def query(self, words):
-        branch = self
+        node = self.node
         for word in words:
-            if word not in branch.branches:
+            node = self.trie.child(node, word)
+            if node is None:
                 return None
-            else:
-                branch = branch.branches[word]
-        return branch
+        return WordTrieBranch(self.trie, node)
 
     def query_word(self, word):
-        if word not in self.branches:
+        node = self.trie.child(self.node, word)
+        if node is None:
             return None
-        else:
-            return self.branches[word]
+        return WordTrieBranch(self.trie, node)
+
+    # Yields a (word, branch) tuple for every branch below this one.
+    def items(self):
+        for word, node in self.trie.children(self.node):
+            yield word, WordTrieBranch(self.trie, node)
 
 
+# A trie of names, each a list of words. Words are interned as integer ids
+# and nodes are numbered from 0 (the root), with the node data in flat
+# arrays indexed by node: the name counts, the id of the word on the edge
+# into the node, and the first child and next sibling of the node, which
+# link the children of each node into a list. The edges are two parallel
+# arrays, the sorted edge keys (see EDGE_SHIFT) and the child each one leads
+# to, searched by bisection. New edges go into a small dict first and are
+# merged into the arrays in bulk (see merge_edges()). Nodes no name passes
+# through any more are unlinked when a name is removed and reused by later
+# names.
 class WordTrie:
     def __init__(self):
-        self.root = WordTrieBranch()
-
-    def __add(self, words, branch):
-        if words:
-            branch.prefixes += 1
-            word = words[0]
-            if word not in branch.branches:
-                branch.branches[word] = WordTrieBranch()
-            self.__add(words[1:], branch.branches[word])
+        self.word_ids = {}
+        self.word_list = []
+        self.edge_keys = array('q')
+        self.edge_children = array('i')
+        self.edge_buffer = {}
+        self.word_counts = array('i')
+        self.prefix_counts = array('i')
+        self.labels = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.free_nodes = []
+        self.new_node(-1, -1)
+        self.root = WordTrieBranch(self, 0)
+
+    # Returns the number of nodes in use.
+    def __len__(self):
+        return len(self.word_counts) - len(self.free_nodes)
+
+    def new_node(self, parent, word_id):
+        if self.free_nodes:
+            node = self.free_nodes.pop()
+            self.word_counts[node] = 0
+            self.prefix_counts[node] = 0
+            self.labels[node] = word_id
+            self.first_child[node] = -1
+            self.next_sibling[node] = -1
         else:
-            branch.words += 1
+            node = len(self.word_counts)
+            self.word_counts.append(0)
+            self.prefix_counts.append(0)
+            self.labels.append(word_id)
+            self.first_child.append(-1)
+            self.next_sibling.append(-1)
+        if parent >= 0:
+            self.next_sibling[node] = self.first_child[parent]
+            self.first_child[parent] = node
+        return node
+
+    # Returns the id of word, adding it if add is True. Returns None for an
+    # unknown word otherwise.
+    def word_id(self, word, add=False):
+        word_id = self.word_ids.get(word)
+        if word_id is None and add:
+            word_id = self.word_ids[word] = len(self.word_list)
+            self.word_list.append(word)
+        return word_id
+
+    # Returns the child node the edge key leads to, or None.
+    def edge(self, key):
+        if self.edge_buffer:
+            child = self.edge_buffer.get(key)
+            if child is not None:
+                return child
+
+        keys = self.edge_keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return self.edge_children[i]
+        return None
+
+    # Move the edges in the insert buffer into the sorted edge arrays. The
+    # buffered keys are sorted and placed by bisection, and the runs of the
+    # old arrays between them are copied as slices.
+    def merge_edges(self):
+        if not self.edge_buffer:
+            return
+
+        old_keys = self.edge_keys
+        old_children = self.edge_children
+        keys = array('q')
+        children = array('i')
+        copied = 0
+        for key in sorted(self.edge_buffer):
+            i = bisect_left(old_keys, key, copied)
+            keys.extend(old_keys[copied:i])
+            children.extend(old_children[copied:i])
+            keys.append(key)
+            children.append(self.edge_buffer[key])
+            copied = i
+        keys.extend(old_keys[copied:])
+        children.extend(old_children[copied:])
+
+        self.edge_keys = keys
+        self.edge_children = children
+        self.edge_buffer = {}
+
+    # Returns the number of edges.
+    def edge_count(self):
+        return len(self.edge_keys) + len(self.edge_buffer)
+
+    # Returns the child of node along the given word, or None.
+    def child(self, node, word):
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            return None
+        return self.edge((node << EDGE_SHIFT) | word_id)
+
+    # Yields a (word, node) tuple for every child of node.
+    def children(self, node):
+        child = self.first_child[node]
+        while child != -1:
+            yield self.word_list[self.labels[child]], child
+            child = self.next_sibling[child]
 
     def add(self, words):
-        self.__add(words, self.root)
+        node = 0
+        for word in words:
+            self.prefix_counts[node] += 1
+            key = (node << EDGE_SHIFT) | self.word_id(word, add=True)
+            child = self.edge(key)
+            if child is None:
+                child = self.edge_buffer[key] = self.new_node(node, key & ((1 << EDGE_SHIFT) - 1))
+            node = child
+        self.word_counts[node] += 1
+
+        if len(self.edge_buffer) >= max(EDGE_BUFFER_SIZE, len(self.edge_keys) >> 3):
+            self.merge_edges()
+
+    # Remove one copy of a name added with add(). Returns False if the trie
+    # does not contain the name.
+    def remove(self, words):
+        path = [0]
+        for word in words:
+            node = self.child(path[-1], word)
+            if node is None:
+                return False
+            path.append(node)
+
+        if self.word_counts[path[-1]] == 0:
+            return False
+
+        self.word_counts[path[-1]] -= 1
+        for node in path[:-1]:
+            self.prefix_counts[node] -= 1
+
+        # Unlink the nodes that were only on the path of this name, deepest
+        # first.
+        for i in range(len(path) - 1, 0, -1):
+            node = path[i]
+            if self.word_counts[node] or self.prefix_counts[node]:
+                break
+            self.drop_node(path[i - 1], node)
+
+        return True
+
+    def drop_node(self, parent, node):
+        key = (parent << EDGE_SHIFT) | self.labels[node]
+        if self.edge_buffer.pop(key, None) is None:
+            i = bisect_left(self.edge_keys, key)
+            del self.edge_keys[i]
+            del self.edge_children[i]
+
+        if self.first_child[parent] == node:
+            self.first_child[parent] = self.next_sibling[node]
+        else:
+            sibling = self.first_child[parent]
+            while self.next_sibling[sibling] != node:
+                sibling = self.next_sibling[sibling]
+            self.next_sibling[sibling] = self.next_sibling[node]
+
+        self.free_nodes.append(node)
 
     def query(self, words):
         return self.root.query(words)
 
     def query_word(self, word):
         return self.root.query_word(word)
+
+    # Returns the trie as a snapshot (see SNAPSHOT_HEADER), tagged with tag,
+    # 20 bytes identifying what the trie was built from, and version, the
+    # version of the code that split the names into words.
+    def to_snapshot(self, tag, version=0):
+        self.merge_edges()
+        keys = self.edge_keys
+        children = self.edge_children
+        free_nodes = array('i', self.free_nodes)
+
+        text = ''.join(self.word_list)
+        ends = array('q', itertools.accumulate(map(len, self.word_list)))
+        data = text.encode('utf-8')
+
+        arrays = [self.word_counts, self.prefix_counts, self.labels, self.first_child, self.next_sibling,
+                  free_nodes, keys, children, ends]
+        if sys.byteorder != 'little':
+            arrays = [array(a.typecode, a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, tag, version, len(self.word_counts), len(free_nodes), len(keys),
+                                      len(self.word_list), len(data))
+        return b''.join([header] + [a.tobytes() for a in arrays] + [data])
+
+    # Load a trie from a snapshot made by to_snapshot(). buffer may be any
+    # bytes-like object, such as a memory-mapped file. Returns None if the
+    # snapshot has a different tag or version or is not a valid snapshot.
+    @classmethod
+    def from_snapshot(cls, buffer, tag, version=0):
+        view = memoryview(buffer)
+        if len(view) < SNAPSHOT_HEADER.size:
+            return None
+
+        magic, snapshot_tag, snapshot_version, nodes, free, edges, words, size = SNAPSHOT_HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or snapshot_tag != tag or snapshot_version != version:
+            return None
+
+        counts = [nodes, nodes, nodes, nodes, nodes, free, edges, edges, words]
+        typecodes = ['i', 'i', 'i', 'i', 'i', 'i', 'q', 'i', 'q']
+        array_sizes = (count * array(typecode).itemsize for count, typecode in zip(counts, typecodes))
+        expected = SNAPSHOT_HEADER.size + size + sum(array_sizes)
+        if len(view) != expected or nodes == 0:
+            return None
+
+        offset = SNAPSHOT_HEADER.size
+        arrays = []
+        for count, typecode in zip(counts, typecodes):
+            a = array(typecode)
+            end = offset + count * a.itemsize
+            a.frombytes(view[offset:end])
+            if sys.byteorder != 'little':
+                a.byteswap()
+            arrays.append(a)
+            offset = end
+
+        try:
+            text = str(view[offset:], 'utf-8')
+        except UnicodeDecodeError:
+            return None
+
+        word_counts, prefix_counts, labels, first_child, next_sibling, free_nodes, keys, children, ends = arrays
+
+        trie = cls.__new__(cls)
+        trie.word_list = [text[start:end] for start, end in zip(itertools.chain([0], ends), ends)]
+        trie.word_ids = dict(zip(trie.word_list, range(words)))
+        trie.edge_keys = keys
+        trie.edge_children = children
+        trie.edge_buffer = {}
+        trie.word_counts = word_counts
+        trie.prefix_counts = prefix_counts
+        trie.labels = labels
+        trie.first_child = first_child
+        trie.next_sibling = next_sibling
+        trie.free_nodes = free_nodes.tolist()
+        trie.root = WordTrieBranch(trie, 0)
+
+        return trie
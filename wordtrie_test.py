@@ -22,7 +22,7 @@
 
 import unittest
 
-from wordtrie import WordTrie
+from wordtrie import EDGE_BUFFER_SIZE, WordTrie
 
 
 class WordTrieTest(unittest.TestCase):
@@ -60,3 +60,115 @@ class WordTrieTest(unittest.TestCase):
 
         branch = trie.query(['koala'])
         self.assertIsNone(branch)
+
+    def test_long_name(self):
+        # Names are added without recursion, however long they are.
+        words = [f'word{i}' for i in range(10000)]
+        trie = WordTrie()
+        trie.add(words)
+
+        branch = trie.query(words)
+        self.assertIsNotNone(branch)
+        self.assertEqual(branch.words, 1)
+        self.assertEqual(len(trie), 10001)
+
+        # Repeated words are stored once.
+        trie.add(['word1', 'word1', 'word1'])
+        self.assertEqual(len(trie.word_list), 10000)
+
+    def test_items(self):
+        trie = WordTrie()
+        trie.add(['atari', 'st'])
+        trie.add(['atari', 'falcon'])
+        trie.add(['apple'])
+
+        self.assertEqual(sorted(word for word, _ in trie.root.items()), ['apple', 'atari'])
+
+        branch = trie.query_word('atari')
+        self.assertEqual(sorted((word, b.words) for word, b in branch.items()), [('falcon', 1), ('st', 1)])
+        self.assertIsNone(branch.query_word('apple'))
+
+    def test_remove(self):
+        trie = WordTrie()
+        trie.add(['atari', 'st'])
+        trie.add(['atari', 'falcon'])
+        trie.add(['atari'])
+        trie.add(['atari'])
+        nodes = len(trie)
+
+        self.assertTrue(trie.remove(['atari', 'st']))
+        self.assertIsNone(trie.query(['atari', 'st']))
+        self.assertEqual(trie.query(['atari']).prefixes, 1)
+        self.assertEqual(len(trie), nodes - 1)
+
+        # Names added twice are counted.
+        self.assertTrue(trie.remove(['atari']))
+        self.assertEqual(trie.query(['atari']).words, 1)
+
+        self.assertFalse(trie.remove(['atari', 'st']))
+        self.assertFalse(trie.remove(['apple']))
+        self.assertFalse(trie.remove(['atari', 'falcon', '030']))
+
+        self.assertTrue(trie.remove(['atari', 'falcon']))
+        self.assertTrue(trie.remove(['atari']))
+        self.assertIsNone(trie.query(['atari']))
+        self.assertEqual(trie.root.prefixes, 0)
+        self.assertEqual(list(trie.root.items()), [])
+        self.assertEqual(len(trie), 1)
+
+        # Removed nodes are reused.
+        trie.add(['apple', 'ii'])
+        self.assertEqual(len(trie.word_counts), nodes)
+        self.assertEqual(trie.query(['apple', 'ii']).words, 1)
+
+    def test_edge_arrays(self):
+        trie = WordTrie()
+        names = [['page', str(i)] for i in range(3 * EDGE_BUFFER_SIZE)]
+        for name in names:
+            trie.add(name)
+
+        # Most edges have been merged into the sorted arrays.
+        self.assertEqual(trie.edge_count(), len(names) + 1)
+        self.assertLess(len(trie.edge_buffer), EDGE_BUFFER_SIZE)
+        self.assertEqual(list(trie.edge_keys), sorted(trie.edge_keys))
+
+        # Edges are found and removed both in the arrays and in the buffer.
+        for name in names[::7]:
+            self.assertTrue(trie.remove(name))
+        for i, name in enumerate(names):
+            branch = trie.query(name)
+            if i % 7:
+                self.assertEqual(branch.words, 1)
+            else:
+                self.assertIsNone(branch)
+        self.assertEqual(trie.edge_count(), len(names) - len(names[::7]) + 1)
+
+        trie.merge_edges()
+        self.assertEqual(trie.edge_buffer, {})
+        self.assertEqual(trie.query(names[1]).words, 1)
+
+    def test_snapshot(self):
+        trie = WordTrie()
+        trie.add(['atari', 'st'])
+        trie.add(['atari', 'falcon'])
+        trie.add(['café'])
+        trie.remove(['atari', 'st'])
+
+        tag = b'\x01' * 20
+        snapshot = trie.to_snapshot(tag)
+
+        loaded = WordTrie.from_snapshot(memoryview(snapshot), tag)
+        self.assertEqual(loaded.query(['atari', 'falcon']).words, 1)
+        self.assertEqual(loaded.query(['café']).words, 1)
+        self.assertIsNone(loaded.query(['atari', 'st']))
+        self.assertEqual(loaded.free_nodes, trie.free_nodes)
+
+        # A loaded trie can be changed like any other.
+        loaded.add(['atari', 'st'])
+        self.assertEqual(loaded.query(['atari']).prefixes, 2)
+
+        self.assertIsNone(WordTrie.from_snapshot(snapshot, b'\x02' * 20))
+        self.assertIsNone(WordTrie.from_snapshot(snapshot, tag, 1))
+        self.assertIsNotNone(WordTrie.from_snapshot(trie.to_snapshot(tag, 1), tag, 1))
+        self.assertIsNone(WordTrie.from_snapshot(snapshot[:-1], tag))
+        self.assertIsNone(WordTrie.from_snapshot(b'', tag))